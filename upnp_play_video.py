@@ -1,203 +1,816 @@
 import requests
 import xml.etree.ElementTree as ET
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import threading
 import time
 import lxml.etree as etree
 import socket
 import netifaces as ni
-import shutil
+import hashlib
 import os
 import random
-from urllib.parse import urlparse
+import ipaddress
+import selectors
+import struct
+from collections import deque
+from urllib.parse import urlparse, urljoin, unquote
 import mimetypes
 import configparser
 import re
 import sys
-import ast
+import signal
+import json
+import gzip
 from pynput import keyboard
 import subprocess
+import queue
+import shutil
+import concurrent.futures
+import ctypes
+import ctypes.util
+import atexit
+try:
+    from jeepney import DBusAddress, new_method_call
+    from jeepney.io.blocking import open_dbus_connection
+except ImportError:
+    DBusAddress = None  # D-Bus notifications need the optional jeepney package
 
 
 
 # --- Read configuration from config.ini
-config = configparser.ConfigParser()
-config.read('./config.ini')
-default_section = config['DEFAULT']
+CONFIG_FILE = './config.ini'
 
-SERVER_PORT = None  # Initialize to None for error checking
-threshold = None
-order_files = None
-directory_path = None
 
-try:
-    SERVER_PORT = default_section.getint('SERVER_PORT')
-except ValueError:
-    print("Error: SERVER_PORT must be an integer in config file.")
-    # Handle the error: use a default, exit, etc.
-    SERVER_PORT = 8080 # Example default
+class ConfigOption:
+    """
+    One key of config.ini: its type, default value and accepted values.
 
-try:
-    threshold = default_section.getint('threshold')
-except ValueError:
-    print("Error: threshold must be an integer in config file.")
-    threshold = 100 # Example default
+    Args:
+        name: The key in config.ini.
+        kind: bool, int, float, str or list (comma separated strings).
+        default: The value used when the key is missing or invalid, in the
+            unit of config.ini.
+        choices: The accepted values of a str option, matched case-insensitively.
+        minimum: The smallest accepted int or float value.
+        maximum: The largest accepted int or float value.
+        scale: A factor applied to the value, e.g. 1024 for kilobytes.
+        variable: The attribute of config holding the value, the key by default.
+        reloadable: False if a new value only takes effect after a restart.
+        lowercase: True to lowercase str and list values.
+    """
 
-try:
-    order_files_str = default_section['order_files']  # Read as string first
-    print(f"order_files_str: {order_files_str}")
-    order_files = ast.literal_eval(order_files_str) 
-    print(f"order_files: {order_files}")
-except KeyError:
-    print("Error: order_files is missing in config file.")
-    order_files = False  # Default
-except ValueError: # this will never be raised now, but can be useful to catch other errors
-    print("Error: order_files must be a boolean (true/false/1/0/yes/no) in config file.")
-    order_files = False  # Default
+    def __init__(self, name, kind, default, choices=None, minimum=None, maximum=None, scale=1,
+                 variable=None, reloadable=True, lowercase=False):
+        self.name = name
+        self.kind = kind
+        self.default = default
+        self.choices = choices
+        self.minimum = minimum
+        self.maximum = maximum
+        self.scale = scale
+        self.variable = variable or name
+        self.reloadable = reloadable
+        self.lowercase = lowercase or choices is not None
 
-try:
-    directory_path = default_section['directory_path']
-except KeyError:
-    print("Error: directory_path is missing in config file.")
-    directory_path = "./music"  # Example default
+    def default_value(self):
+        return self.default * self.scale if self.scale != 1 else self.default
+
+    def parse(self, section):
+        """
+        Returns the value of the option in a config section, or its default if the key is missing.
+
+        Raises:
+            ValueError: If the value has the wrong type or is not accepted.
+        """
+        raw = section.get(self.name)
+        if raw is None or (not raw.strip() and self.kind in (bool, int, float)):
+            return self.default_value()
+        raw = raw.strip()
+        if self.kind is bool:
+            if raw.lower() not in configparser.ConfigParser.BOOLEAN_STATES:
+                raise ValueError(f"{self.name} must be a boolean (true/false/1/0/yes/no)")
+            return configparser.ConfigParser.BOOLEAN_STATES[raw.lower()]
+        if self.kind is list:
+            return [item.strip().lower() if self.lowercase else item.strip() for item in raw.split(',') if item.strip()]
+        if self.kind in (int, float):
+            try:
+                value = self.kind(raw)
+            except ValueError:
+                raise ValueError(f"{self.name} must be {'an integer' if self.kind is int else 'a number'}") from None
+            if self.minimum is not None and value < self.minimum:
+                raise ValueError(f"{self.name} must be at least {self.minimum}")
+            if self.maximum is not None and value > self.maximum:
+                raise ValueError(f"{self.name} must be at most {self.maximum}")
+            return value * self.scale if self.scale != 1 else value
+        value = raw.lower() if self.lowercase else raw
+        if self.choices and value not in self.choices:
+            raise ValueError(f"{self.name} must be {', '.join(self.choices[:-1])} or {self.choices[-1]}")
+        return value
+
+
+CONFIG_OPTIONS = [
+    ConfigOption('SERVER_PORT', int, 8080, minimum=1, maximum=65535, reloadable=False),
+    ConfigOption('threshold', int, 100),
+    ConfigOption('order_files', bool, False),
+    ConfigOption('directory_path', str, './music'),
+    ConfigOption('include_unnumbered', bool, True),
+    # An M3U, M3U8, PLS or XSPF file to play instead of the files of directory_path
+    ConfigOption('playlist', str, ''),
+    ConfigOption('shuffle_mode', str, 'random', choices=('random', 'weighted', 'artist_spread')),
+    ConfigOption('repeat_mode', str, 'off', choices=('off', 'all', 'one')),
+    ConfigOption('history_file', str, './play_history.txt', reloadable=False),
+    ConfigOption('history_size', int, 200, minimum=0),
+    ConfigOption('resume_playback', bool, True),
+    ConfigOption('resume_state_file', str, './resume_state.json'),
+    ConfigOption('checkpoint_interval', int, 15, minimum=1),
+    ConfigOption('poll_interval', float, 10, minimum=0.1),
+    ConfigOption('min_poll_interval', float, 1, minimum=0.1),
+    ConfigOption('position_sync_interval', float, 60, minimum=1),
+    ConfigOption('prepare_ahead', float, 15, minimum=0),
+    # Comma separated interface names used for discovery, empty means all interfaces
+    ConfigOption('interfaces', list, [], variable='ssdp_interfaces', reloadable=False),
+    ConfigOption('ipv6', bool, True, variable='use_ipv6', reloadable=False),
+    ConfigOption('ssdp_listen', bool, True, reloadable=False),
+    ConfigOption('volume_step', int, 5, minimum=1, maximum=100),
+    ConfigOption('volume_interval', float, 0.3, minimum=0),
+    ConfigOption('notification_sink', str, 'auto', choices=('auto', 'dbus', 'notify-send', 'log', 'webhook', 'none'), reloadable=False),
+    ConfigOption('notification_webhook_url', str, 'http://127.0.0.1:8123/notify'),
+    # Kilobytes per second, 0 means unlimited
+    ConfigOption('max_rate', int, 0, minimum=0, scale=1024),
+    ConfigOption('connection_rate', int, 0, minimum=0, scale=1024),
+    ConfigOption('background_rate', int, 0, minimum=0, scale=1024),
+    ConfigOption('video_probe', str, 'auto', choices=('auto', 'builtin', 'ffprobe', 'none')),
+    ConfigOption('video_probe_workers', int, 4, minimum=1, reloadable=False),
+    ConfigOption('video_cache_file', str, './video_metadata_cache.json', reloadable=False),
+    ConfigOption('subtitles', bool, True),
+    # Comma separated preferred subtitle languages, e.g. "en,fr"
+    ConfigOption('subtitle_languages', list, [], lowercase=True),
+    ConfigOption('subtitle_cache_dir', str, './subtitle_cache'),
+    ConfigOption('hls_mode', str, 'off', choices=('off', 'auto', 'always')),
+    ConfigOption('hls_min_size', float, 4000, minimum=0),
+    ConfigOption('hls_segment_duration', int, 6, minimum=1),
+    ConfigOption('hls_cache_dir', str, './hls_cache'),
+    ConfigOption('hls_cache_limit', float, 50000, minimum=0),
+    ConfigOption('watch_folder', bool, False),
+    ConfigOption('watch_append', bool, True),
+    ConfigOption('watch_settle_time', float, 5, minimum=0),
+    ConfigOption('watch_poll_interval', float, 10, minimum=1),
+    ConfigOption('server_threads', int, 32, minimum=1, reloadable=False),
+    # Kilobytes sent with the headers, and per sendfile() call
+    ConfigOption('first_chunk_size', int, 64, minimum=1, scale=1024),
+    ConfigOption('send_chunk_size', int, 1024, minimum=16, scale=1024),
+    ConfigOption('content_table_size', int, 1000, minimum=10),
+    ConfigOption('soap_timeout', float, 10, minimum=0.1),
+    ConfigOption('http_timeout', float, 5, minimum=0.1),
+    ConfigOption('health_backoff', float, 1, minimum=0.1),
+    ConfigOption('health_max_backoff', float, 30, minimum=0.1),
+    ConfigOption('health_max_failures', int, 4, minimum=1),
+    # Comma separated friendly names or UDNs of the renderers to fail over to
+    ConfigOption('failover_renderers', list, [], lowercase=True),
+    ConfigOption('failover_after', float, 60, minimum=0),
+    ConfigOption('quirks_file', str, './renderer_quirks.json'),
+    ConfigOption('config_check_interval', float, 2, minimum=0, reloadable=False),
+    ConfigOption('capture_file', str, '', reloadable=False),
+]
+
+
+def load_config(config_file, current=None):
+    """
+    Reads and validates config.ini.
+
+    Args:
+        config_file: The path of the config file.
+        current: The values in use when reloading. An invalid value (or an
+            unreadable file) keeps the current values instead of the defaults.
+
+    Returns:
+        A dict of variable name to value for every option of CONFIG_OPTIONS.
+    """
+    parser = configparser.ConfigParser(inline_comment_prefixes=('#',), interpolation=None)
+    try:
+        parser.read(config_file, encoding='utf-8')
+    except configparser.Error as e:
+        print(f"Error reading {config_file}: {e}")
+        # A half read file is not used, keep everything as it is
+        if current:
+            return dict(current)
+        return {option.variable: option.default_value() for option in CONFIG_OPTIONS}
+    if current and not parser.defaults():
+        # Missing, or emptied by an editor that is still saving it
+        print(f"{config_file} is empty, configuration not reloaded.")
+        return dict(current)
+    values = {}
+    for option in CONFIG_OPTIONS:
+        try:
+            values[option.variable] = option.parse(parser['DEFAULT'])
+        except ValueError as e:
+            print(f"Error: {e} in config file.")
+            values[option.variable] = current[option.variable] if current else option.default_value()
+    return values
+
+
+class Config:
+    """
+    The values of CONFIG_OPTIONS, as attributes named after their variable.
+
+    A reload updates the one instance in place, so every reader sees the new
+    values; a name that is not an option raises AttributeError.
+    """
+
+    __slots__ = tuple(option.variable for option in CONFIG_OPTIONS)
 
+    def __init__(self, values):
+        self.update(values)
 
-# Check if all required variables were successfully loaded
-if SERVER_PORT is None or threshold is None or order_files is None or directory_path is None:
-    print("Error: Some required configuration values could not be loaded.")
-    exit(1)  # Or handle it differently
+    def update(self, values):
+        for variable, value in values.items():
+            setattr(self, variable, value)
 
-print(SERVER_PORT, threshold, order_files, directory_path) # Test/verify
+    def values(self):
+        """Returns a dict of variable name to value, as load_config() does."""
+        return {variable: getattr(self, variable) for variable in self.__slots__}
+
+
+config = Config(load_config(CONFIG_FILE))
+
+print(config.SERVER_PORT, config.threshold, config.order_files, config.directory_path) # Test/verify
+
+
+# --- Traffic capture ---
+# Response headers worth replaying, the others describe the connection
+CAPTURED_HEADERS = ('content-type', 'etag', 'last-modified', 'server', 'ext')
+
+class TrafficRecorder:
+    """
+    Writes the traffic with the renderers to capture_file, one JSON object
+    per line, for upnp_replay.py to play back. A name ending in .gz is compressed.
+
+    Every record has t, the seconds since the capture started, and kind:
+    search (an M-SEARCH sent), ssdp (a datagram received, with data and addr)
+    or http (a description, SCPD or SOAP request with its method, url,
+    headers and body, the status, response_headers and response, or the
+    error, and its latency in seconds).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.started = time.time()
+        self.lock = threading.Lock()
+        opener = gzip.open if path.endswith('.gz') else open
+        self.file = opener(path, 'wt', encoding='utf-8')
+        # A compressed file is unreadable without its trailer
+        atexit.register(self.close)
+
+    def record(self, kind, **fields):
+        entry = {'t': round(time.time() - self.started, 4), 'kind': kind}
+        entry.update(fields)
+        line = json.dumps(entry, separators=(',', ':'))
+        with self.lock:
+            try:
+                self.file.write(line + '\n')
+                self.file.flush()
+            except (OSError, ValueError) as e:
+                print(f"Error writing capture {self.path}: {e}")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def capture_ssdp(data, addr):
+    """Records a received SSDP datagram if capture_file is set."""
+    if traffic_recorder:
+        traffic_recorder.record('ssdp', data=data.decode('utf-8', errors='replace'), addr=addr[0] if addr else None)
+
+
+def capture_http(method, url, started, response=None, error=None, headers=None, body=None):
+    """Records a request to a renderer and its response (or error) if capture_file is set."""
+    if not traffic_recorder:
+        return
+    fields = {'method': method, 'url': url, 'latency': round(time.time() - started, 4)}
+    if headers:
+        fields['headers'] = headers
+    if body is not None:
+        fields['body'] = body
+    if response is not None:
+        fields['status'] = response.status_code
+        fields['response_headers'] = {name: value for name, value in response.headers.items() if name.lower() in CAPTURED_HEADERS}
+        fields['response'] = response.text
+    if error is not None:
+        fields['error'] = str(error)
+    traffic_recorder.record('http', **fields)
+
+
+traffic_recorder = None
+if config.capture_file:
+    try:
+        traffic_recorder = TrafficRecorder(config.capture_file)
+        print(f"Capturing the traffic with the renderer to {config.capture_file}")
+    except OSError as e:
+        print(f"Error opening capture {config.capture_file}: {e}")
 
 
 # --- UPNP SSDP protocol
+SSDP_MULTICAST_V4 = '239.255.255.250'
+SSDP_MULTICAST_V6 = 'ff02::c'
+SSDP_PORT = 1900
+SSDP_MX = 3
+
+MEDIA_RENDERER_ST = 'urn:schemas-upnp-org:device:MediaRenderer:1'
+# Max-age used when a device does not send CACHE-CONTROL
+DEFAULT_MAX_AGE = 1800
+# Largest UDP payload, so long SSDP messages are never truncated
+SSDP_BUFFER_SIZE = 65507
+
+class RendererRegistry:
+    """
+    Live list of the MediaRenderers on the network, kept up to date from SSDP.
+
+    Entries come from M-SEARCH responses and ssdp:alive NOTIFYs, are removed
+    on ssdp:byebye and expire after the max-age announced by the device. They
+    are keyed by the device UUID from the USN, so a device answering on
+    several interfaces or for several services is listed (and fetched) once.
+    """
+
+    def __init__(self):
+        self.renderers = {}  # device key -> {'location', 'server', 'usn', 'bootid', 'expires'}
+        self.lock = threading.Lock()
+
+    def alive(self, headers):
+        """Adds or refreshes the renderer described by the headers of an SSDP message."""
+        key = ssdp_device_key(headers)
+        bootid = headers.get('BOOTID.UPNP.ORG')
+        with self.lock:
+            entry = self.renderers.get(key)
+            if entry and bootid and entry['bootid'] and entry['bootid'] != bootid:
+                print(f"Renderer rebooted: {entry['server']} ({headers['LOCATION']})")
+                if headers['LOCATION'] in description_cache:
+                    description_cache[headers['LOCATION']].stale = True
+            self.renderers[key] = {
+                'location': headers['LOCATION'],
+                'server': headers.get('SERVER', ''),
+                'usn': headers.get('USN'),
+                'bootid': bootid,
+                'expires': time.time() + parse_max_age(headers.get('CACHE-CONTROL')),
+            }
+        renderer_health.seen(key, headers['LOCATION'])
+
+    def byebye(self, usn):
+        """Removes the device that sent an ssdp:byebye for usn."""
+        entry = None
+        with self.lock:
+            entry = self.renderers.pop(usn.split('::')[0], None)
+        renderer_health.left(usn.split('::')[0])
+        if entry:
+            print(f"Renderer left the network: {entry['server']} ({entry['location']})")
+
+    def lookup(self):
+        """Returns the (location, server) pairs of the renderers that have not expired."""
+        now = time.time()
+        with self.lock:
+            for key, entry in list(self.renderers.items()):
+                if entry['expires'] < now:
+                    del self.renderers[key]
+            return sorted((entry['location'], entry['server']) for entry in self.renderers.values())
+
+
+renderer_registry = RendererRegistry()
+
+
+class SSDPHeaders(dict):
+    """Header map of an SSDP message. Header names are case-insensitive."""
+
+    def __setitem__(self, name, value):
+        super().__setitem__(name.upper(), value)
+
+    def __getitem__(self, name):
+        return super().__getitem__(name.upper())
+
+    def __contains__(self, name):
+        return super().__contains__(name.upper())
+
+    def get(self, name, default=None):
+        return super().get(name.upper(), default)
+
+
+def parse_ssdp_message(data):
+    """
+    Parses an SSDP datagram.
+
+    Lines without a colon are skipped and the first occurrence of a repeated
+    header wins, so malformed packets never raise.
+
+    Args:
+        data: The datagram, as bytes or str.
+
+    Returns:
+        A (kind, headers) tuple where kind is 'notify', 'm-search' or
+        'response' and headers is an SSDPHeaders, or None if data is not an
+        SSDP message.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', errors='replace')
+    lines = data.splitlines()
+    if not lines:
+        return None
+
+    start_line = lines[0].strip().upper().split()
+    if not start_line:
+        return None
+    if start_line[0] == 'NOTIFY':
+        kind = 'notify'
+    elif start_line[0] == 'M-SEARCH':
+        kind = 'm-search'
+    elif start_line[0].startswith('HTTP/1.') and len(start_line) > 1 and start_line[1] == '200':
+        kind = 'response'
+    else:
+        return None
+
+    headers = SSDPHeaders()
+    for line in lines[1:]:
+        if not line.strip():
+            break  # End of the headers
+        name, sep, value = line.partition(':')
+        name = name.strip()
+        if sep and name and name not in headers:
+            headers[name] = value.strip()
+    return kind, headers
+
+
+def ssdp_device_key(headers):
+    """Returns the device UUID from the USN header, or the LOCATION if there is no USN."""
+    usn = headers.get('USN')
+    if usn:
+        return usn.split('::')[0]
+    return headers.get('LOCATION')
+
+
+def parse_max_age(cache_control):
+    """Returns the max-age in seconds from a CACHE-CONTROL header value."""
+    match = re.search(r"max-age\s*=\s*(\d+)", cache_control or '', re.IGNORECASE)
+    return int(match.group(1)) if match else DEFAULT_MAX_AGE
+
+
+def handle_ssdp_message(data):
+    """Updates renderer_registry from an M-SEARCH response or a NOTIFY."""
+    parsed = parse_ssdp_message(data)
+    if parsed is None:
+        return
+    kind, headers = parsed
+    if kind == 'm-search':
+        return
+    if kind == 'notify':
+        nts = headers.get('NTS')
+        if nts == 'ssdp:byebye':
+            if headers.get('USN'):
+                renderer_registry.byebye(headers['USN'])
+            return
+        if nts not in ('ssdp:alive', 'ssdp:update'):
+            return
+        target = headers.get('NT', '')
+    else:
+        target = headers.get('ST', '')
+    if 'urn:schemas-upnp-org:device:MediaRenderer:' in target and headers.get('LOCATION'):
+        renderer_registry.alive(headers)
+
+
+def open_ssdp_listener_sockets():
+    """
+    Opens the sockets receiving SSDP NOTIFYs on port 1900.
+
+    The IPv4 socket joins 239.255.255.250 on every interface address, the
+    IPv6 socket joins ff02::c on every interface.
+    """
+    listener_sockets = []
+    interface_addresses = get_interface_addresses()
+
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', SSDP_PORT))
+        joined = False
+        for interface, family, address in interface_addresses:
+            if family != socket.AF_INET:
+                continue
+            try:
+                mreq = socket.inet_aton(SSDP_MULTICAST_V4) + socket.inet_aton(address)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+                joined = True
+            except OSError as e:
+                print(f"Error joining SSDP group on {interface}: {e}")
+        if not joined:
+            mreq = socket.inet_aton(SSDP_MULTICAST_V4) + socket.inet_aton('0.0.0.0')
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        listener_sockets.append(sock)
+    except OSError as e:
+        print(f"Error opening the SSDP listener: {e}")
+
+    if config.use_ipv6 and socket.has_ipv6:
+        try:
+            sock6 = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock6.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                sock6.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock6.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+            sock6.bind(('::', SSDP_PORT))
+            for interface, family, address in interface_addresses:
+                if family == socket.AF_INET6:
+                    mreq = socket.inet_pton(socket.AF_INET6, SSDP_MULTICAST_V6) + struct.pack('@I', socket.if_nametoindex(interface))
+                    sock6.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_JOIN_GROUP, mreq)
+            listener_sockets.append(sock6)
+        except OSError as e:
+            print(f"Error opening the IPv6 SSDP listener: {e}")
+
+    return listener_sockets
+
+
+def run_ssdp_listener(listener_sockets):
+    """Processes SSDP NOTIFYs forever."""
+    sel = selectors.DefaultSelector()
+    for sock in listener_sockets:
+        sel.register(sock, selectors.EVENT_READ)
+    while True:
+        for key, _ in sel.select():
+            try:
+                data, addr = key.fileobj.recvfrom(SSDP_BUFFER_SIZE)
+                capture_ssdp(data, addr)
+                handle_ssdp_message(data)
+            except Exception as e:
+                print(f"Error in SSDP listener: {e}")
+
+
+def start_ssdp_listener():
+    """Starts the SSDP NOTIFY listener in a daemon thread. Returns False if it could not be started."""
+    listener_sockets = open_ssdp_listener_sockets()
+    if not listener_sockets:
+        return False
+    listener_thread = threading.Thread(target=run_ssdp_listener, args=(listener_sockets,))
+    listener_thread.daemon = True
+    listener_thread.start()
+    return True
+
+
+def get_interface_addresses():
+    """
+    Lists the addresses usable for discovery on each network interface.
+
+    Loopback and IPv4 link-local addresses are skipped, as are interfaces not
+    listed in the interfaces option when it is set.
+
+    Returns:
+        A list of (interface, family, address) tuples.
+    """
+    interface_addresses = []
+    for interface in ni.interfaces():
+        if config.ssdp_interfaces and interface not in config.ssdp_interfaces:
+            continue
+        addresses = ni.ifaddresses(interface)
+        for address in addresses.get(ni.AF_INET, []):
+            ip = ipaddress.ip_address(address['addr'])
+            if not ip.is_loopback and not ip.is_link_local:
+                interface_addresses.append((interface, socket.AF_INET, address['addr']))
+        if config.use_ipv6 and socket.has_ipv6:
+            # One IPv6 socket per interface is enough for the link-scope multicast group
+            for address in addresses.get(ni.AF_INET6, []):
+                ip = ipaddress.ip_address(address['addr'].split('%')[0])
+                if not ip.is_loopback:
+                    interface_addresses.append((interface, socket.AF_INET6, str(ip)))
+                    break
+    return interface_addresses
+
+
+def open_ssdp_sockets(message):
+    """
+    Opens one SSDP socket per interface address and sends message out of each.
+
+    IP_MULTICAST_IF / IPV6_MULTICAST_IF pin every socket to its interface, so
+    the M-SEARCH reaches every LAN instead of only the one the kernel picks.
+
+    Returns:
+        A list of (socket, interface, family) tuples for the sockets that sent the message.
+    """
+    ssdp_sockets = []
+    for interface, family, address in get_interface_addresses():
+        try:
+            sock = socket.socket(family, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        except OSError as e:
+            print(f"Error creating socket for {interface}: {e}")
+            continue
+        try:
+            if family == socket.AF_INET:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(address))
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+                sock.bind((address, 0))
+                destination = (SSDP_MULTICAST_V4, SSDP_PORT)
+                payload = message
+            else:
+                scope_id = socket.if_nametoindex(interface)
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_MULTICAST_IF, scope_id)
+                sock.bind(('::', 0, 0, scope_id))
+                destination = (SSDP_MULTICAST_V6, SSDP_PORT, 0, scope_id)
+                payload = message.replace(b'HOST: 239.255.255.250:1900', b'HOST: [FF02::C]:1900')
+            sock.sendto(payload, destination)
+            ssdp_sockets.append((sock, interface, family))
+        except OSError as e:
+            print(f"Error sending M-SEARCH on {interface} ({address}): {e}")
+            sock.close()
+    return ssdp_sockets
+
+
 def discover_devices():
-    """Discovers UPnP Media Renderers on the network, preventing duplicates and handling errors."""
-    multicast_address = '239.255.255.250'
-    multicast_port = 1900
+    """
+    Discovers UPnP Media Renderers on all interfaces in parallel, preventing duplicates and handling errors.
 
+    Only MediaRenderers are searched for. The responses are added to
+    renderer_registry, whose content is returned.
+    """
     message = b'M-SEARCH * HTTP/1.1\r\n' \
               b'HOST: 239.255.255.250:1900\r\n' \
               b'MAN: "ssdp:discover"\r\n' \
-              b'MX: 3\r\n' \
-              b'ST: ssdp:all\r\n\r\n'
+              b'MX: ' + str(SSDP_MX).encode() + b'\r\n' \
+              b'ST: ' + MEDIA_RENDERER_ST.encode() + b'\r\n\r\n'
 
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.settimeout(5)
-        sock.sendto(message, (multicast_address, multicast_port))
-    except socket.error as e:
-        print(f"Error creating or sending socket: {e}")
-        return []  # Return empty list on error
+    ssdp_sockets = open_ssdp_sockets(message)
+    if traffic_recorder:
+        traffic_recorder.record('search', data=message.decode())
+    if not ssdp_sockets:
+        # No usable interface found, let the kernel pick one
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            sock.sendto(message, (SSDP_MULTICAST_V4, SSDP_PORT))
+            ssdp_sockets = [(sock, None, socket.AF_INET)]
+        except socket.error as e:
+            print(f"Error creating or sending socket: {e}")
+            return []  # Return empty list on error
 
-    location_server_pairs_set = set()
+    sel = selectors.DefaultSelector()
+    for sock, interface, family in ssdp_sockets:
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
 
+    # Devices answer within MX seconds
+    deadline = time.time() + SSDP_MX + 1
     try:
         while True:
-            try:
-                data, addr = sock.recvfrom(1024)
-                response = data.decode()
-                location_server = extract_location_server(response)
-                if location_server:
-                    if location_server not in location_server_pairs_set: # Check before adding!
-                      location_server_pairs_set.add(location_server)
-                      #print(f"Location: {location_server[0]}")
-                      #print(f"Server: {location_server[1]}")
-            except socket.timeout:
-                #print("No responses received or no responses containing the specified tag.")
+            timeout = deadline - time.time()
+            if timeout <= 0:
                 print(" ")
                 break # Exit the loop when timeout occurs
-            except UnicodeDecodeError:
-                print("Error decoding response. Skipping.") # Handle decoding errors
-            except Exception as e:
-                print(f"An unexpected error occurred: {e}") # Handle general exceptions
+            for key, _ in sel.select(timeout):
+                try:
+                    data, addr = key.fileobj.recvfrom(SSDP_BUFFER_SIZE)
+                    capture_ssdp(data, addr)
+                    handle_ssdp_message(data)
+                except BlockingIOError:
+                    continue
+                except Exception as e:
+                    print(f"An unexpected error occurred: {e}") # Handle general exceptions
 
     finally:
-        if 'sock' in locals(): # Check if socket was created before closing
+        sel.close()
+        for sock, interface, family in ssdp_sockets:
             sock.close()
 
-    return list(location_server_pairs_set)
+    return renderer_registry.lookup()
 
 
-def extract_location_server(response):
-    """Extracts Location and Server information from a UPnP response, handling potential errors."""
-    try:
-        lines = response.splitlines()
-        media_renderer_index = -1
-        for i, line in enumerate(lines):
-            if "urn:schemas-upnp-org:device:MediaRenderer" in line:
-                media_renderer_index = i
-                break
+# --- Device description
+UPNP_DEVICE_NS = {'xmlns': 'urn:schemas-upnp-org:device-1-0'}
 
-        if media_renderer_index != -1:
-            start_index = max(0, media_renderer_index - 7)
-            end_index = min(len(lines) - 1, media_renderer_index + 1)
+# Parsed device descriptions by LOCATION
+description_cache = {}
 
-            lines_to_save = lines[start_index:end_index + 4]
+class DeviceDescription:
+    """
+    A device description XML parsed once: the root device, its embedded
+    devices, their services and icons, with every URL resolved against URLBase.
 
-            location = None
-            server = None
+    Devices are dicts with device_type, friendly_name, manufacturer,
+    model_name, model_number, model_description, udn, services and icons.
+    Services are dicts with service_type, service_id, control_url,
+    event_sub_url and scpd_url.
+    """
 
-            for line in lines_to_save:
-                if line.upper().startswith("LOCATION:"):
-                    location = line.split(":", 1)[1].strip()
-                if line.upper().startswith("SERVER:"):
-                    server = line.split(":", 1)[1].strip()
+    def __init__(self, location, xml_text, etag=None, last_modified=None):
+        self.location = location
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stale = False
 
-            if location and server:
-                return (location, server)
-        return None # Explicitly return None if no match is found or errors occur
+        root = ET.fromstring(xml_text)
+        url_base = root.findtext('xmlns:URLBase', default='', namespaces=UPNP_DEVICE_NS).strip()
+        self.base_url = url_base or location
 
-    except Exception as e:
-        print(f"Error extracting Location/Server: {e}")
-        return None  # Return None on error
+        self.devices = []
+        self.services = {}  # serviceType -> service, first device wins
+        for device in root.iter('{urn:schemas-upnp-org:device-1-0}device'):
+            parsed_device = self.parse_device(device)
+            self.devices.append(parsed_device)
+            for service in parsed_device['services']:
+                self.services.setdefault(service['service_type'], service)
+        if not self.devices:
+            raise ET.ParseError("No device element in description")
+        self.root_device = self.devices[0]
 
+    def resolve(self, url):
+        """Resolves a URL from the description against URLBase (or LOCATION)."""
+        return urljoin(self.base_url, url.strip()) if url else None
 
-def get_control_url(location):
-    """Retrieves the Control URL for the AVTransport service from a device's description XML."""
-    try:
-        response = requests.get(location)
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+    def parse_device(self, device):
+        def text(element, name):
+            value = element.findtext('xmlns:' + name, namespaces=UPNP_DEVICE_NS)
+            return value.strip() if value else None
 
-        root = ET.fromstring(response.text)
+        services = []
+        for service in device.findall('xmlns:serviceList/xmlns:service', UPNP_DEVICE_NS):
+            services.append({
+                'service_type': text(service, 'serviceType'),
+                'service_id': text(service, 'serviceId'),
+                'control_url': self.resolve(text(service, 'controlURL')),
+                'event_sub_url': self.resolve(text(service, 'eventSubURL')),
+                'scpd_url': self.resolve(text(service, 'SCPDURL')),
+            })
 
-        namespaces = {'xmlns': 'urn:schemas-upnp-org:device-1-0'}
-        service_type = "urn:schemas-upnp-org:service:AVTransport:1"
-        control_url = None
+        icons = []
+        for icon in device.findall('xmlns:iconList/xmlns:icon', UPNP_DEVICE_NS):
+            icons.append({
+                'mimetype': text(icon, 'mimetype'),
+                'width': text(icon, 'width'),
+                'height': text(icon, 'height'),
+                'depth': text(icon, 'depth'),
+                'url': self.resolve(text(icon, 'url')),
+            })
 
-        for service in root.findall('.//xmlns:service', namespaces):
-            type_element = service.find('xmlns:serviceType', namespaces)
-            if type_element is not None and type_element.text == service_type:
-                control_url_element = service.find('xmlns:controlURL', namespaces)
-                if control_url_element is not None:
-                    control_url = control_url_element.text
-                    break
+        return {
+            'device_type': text(device, 'deviceType'),
+            'friendly_name': text(device, 'friendlyName'),
+            'manufacturer': text(device, 'manufacturer'),
+            'model_name': text(device, 'modelName'),
+            'model_number': text(device, 'modelNumber'),
+            'model_description': text(device, 'modelDescription'),
+            'udn': text(device, 'UDN'),
+            'services': services,
+            'icons': icons,
+        }
 
-        return control_url
+    @property
+    def friendly_name(self):
+        return self.root_device['friendly_name']
 
-    except requests.exceptions.RequestException as e:
-        print(f"Error during request to {location}: {e}")
-        return None
-    except ET.ParseError as e:
-        print(f"Error parsing XML: {e}")
-        return None
-    except Exception as e:
-        print(f"Other error during XML processing: {e}")
+    def find_service(self, service_name):
+        """
+        Returns the service whose type is urn:schemas-upnp-org:service:<service_name>:<version>.
+
+        Args:
+            service_name: The service name, e.g. "AVTransport".
+        """
+        prefix = f"urn:schemas-upnp-org:service:{service_name}:"
+        for service_type, service in self.services.items():
+            if service_type and service_type.startswith(prefix):
+                return service
         return None
 
-def get_friendly_name(location):
-    """Retrieves the friendly_name from a device's description XML."""
-    try:
-        response = requests.get(location)
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
 
-        root = ET.fromstring(response.text)
+def get_device_description(location):
+    """
+    Returns the DeviceDescription for a LOCATION, downloading it only once.
+
+    A cached description marked stale (e.g. after the device rebooted) is
+    revalidated with If-None-Match / If-Modified-Since, so it is downloaded
+    again only if it changed.
+
+    Returns:
+        The DeviceDescription, or None on error.
+    """
+    cached = description_cache.get(location)
+    if cached and not cached.stale:
+        return cached
 
-        # Find the friendlyName tag within the device tag.  Because of the namespaces, we need to use find with the full path, or use findall and iterate.
-        friendly_name = root.find(".//{urn:schemas-upnp-org:device-1-0}device/{urn:schemas-upnp-org:device-1-0}friendlyName").text
-        return friendly_name
+    headers = {}
+    if cached:
+        if cached.etag:
+            headers['If-None-Match'] = cached.etag
+        if cached.last_modified:
+            headers['If-Modified-Since'] = cached.last_modified
+    started = time.time()
+    try:
+        response = requests.get(location, headers=headers, timeout=config.http_timeout)
+        capture_http('GET', location, started, response, headers=headers)
+        if cached and response.status_code == 304:
+            cached.stale = False
+            return cached
+        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+        description = DeviceDescription(location, response.content,
+                                        response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        description_cache[location] = description
+        return description
 
     except requests.exceptions.RequestException as e:
+        if e.response is None:
+            capture_http('GET', location, started, error=e, headers=headers)
         print(f"Error during request to {location}: {e}")
         return None
     except ET.ParseError as e:
@@ -208,28 +821,31 @@ def get_friendly_name(location):
         return None
 
 
-def process_device(location, server):
-    """Processes a selected device, retrieving the Control URL and printing information."""
-    control_url = get_control_url(location)
+def get_friendly_name(location):
+    """Retrieves the friendly_name from a device's description XML."""
+    description = get_device_description(location)
+    return description.friendly_name if description else None
 
-    if control_url:
-        print(f"Control URL for AVTransport: {control_url}")
 
-        parsed_url = urlparse(location)
-        host = parsed_url.hostname
-        port = parsed_url.port if parsed_url.port else 80
-        host_port = f"{host}:{port}"
-        print(f"Host and port from LOCATION: {host_port}")
+def process_device(location, server):
+    """Processes a selected device, retrieving the Control URL and printing information."""
+    description = get_device_description(location)
+    service = description.find_service("AVTransport") if description else None
 
-        full_url = f"http://{host_port}{control_url}"
-        return full_url
-        print(f"Full URL: {full_url}")
+    if service and service['control_url']:
+        print(f"Control URL for AVTransport: {service['control_url']}")
+        return service['control_url']
     else:
         print(f"AVTransport service not found or error retrieving XML for {server}.")
 
 
 def orchestrate_ssdp():
-    """Main function to orchestrate device discovery and processing."""
+    """
+    Main function to orchestrate device discovery and processing.
+
+    Returns:
+        The LOCATION and the AVTransport control URL of the selected renderer.
+    """
     location_server_pairs = discover_devices()
 
     if location_server_pairs:
@@ -246,7 +862,7 @@ def orchestrate_ssdp():
                 choice = int(input("Select an option: "))
 
                 if choice == 0:
-                    return  # Exit the function
+                    return None, None  # Exit the function
 
                 elif 1 <= choice <= len(location_server_pairs):
                     location_selected = location_server_pairs[choice - 1][0]
@@ -254,7 +870,7 @@ def orchestrate_ssdp():
                     print(f"Location corresponding to {server_selected}: {location_selected}")
                     CONTROL_URL=process_device(location_selected, server_selected)
                     print(f"CONTROL_URL: {CONTROL_URL}")
-                    return CONTROL_URL
+                    return location_selected, CONTROL_URL
                     break  # Exit the loop after a valid selection
 
                 else:
@@ -270,59 +886,131 @@ def orchestrate_ssdp():
 
 
 # --- Returns the local IP address of the machine.
-def get_local_ip():
-    for interface in ni.interfaces():
-        addresses = ni.ifaddresses(interface)
-        if socket.AF_INET in addresses:
-            for ip_address in addresses[socket.AF_INET]:
-                if ip_address['addr'].startswith('192.168') or ip_address['addr'].startswith('10.'):
-                    return ip_address['addr']
+def get_local_ip(target_host=None):
+    """
+    Returns the local address to advertise in the URLs sent to a renderer.
+
+    With target_host the kernel routing table decides: the address is the
+    source address of the route to that host, which is the one the renderer
+    can reach us on. Without it, the first private IPv4 address is returned.
+    """
+    if target_host:
+        try:
+            family = socket.AF_INET6 if ':' in target_host else socket.AF_INET
+            with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                # connect() on a UDP socket only selects the route, nothing is sent
+                sock.connect((target_host, SSDP_PORT))
+                return sock.getsockname()[0].split('%')[0]
+        except OSError as e:
+            print(f"Error finding the route to {target_host}: {e}")
+
+    for interface, family, address in get_interface_addresses():
+        if family == socket.AF_INET and ipaddress.ip_address(address).is_private:
+            return address
     return None
 
+
+def url_host(host):
+    """Returns host as written in a URL, with brackets around IPv6 addresses."""
+    if host and ':' in host and not host.startswith('['):
+        return f"[{host}]"
+    return host
+
 ip_address = get_local_ip()
 print(f"The local IP address is: {ip_address}")
 
 
-def show_notification(title, artist, duration=10000):  # duration in ms
-    message = f"Artist: {artist}"
+# --- Notifications ---
+# Pending notifications, handled by notification_worker() so that track changes never wait for them
+notification_queue = queue.Queue(maxsize=16)
+dbus_connection = None
 
-    subprocess.run([
-        "notify-send",
-        title,
-        message,
-        "-t",
-        str(duration)
-    ])
 
-def copy_file(source_file, destination_file):
-    """
-    Copies a file from a source path to a destination path.
+def notify_dbus(title, message, duration):
+    """Shows a desktop notification with a direct org.freedesktop.Notifications D-Bus call."""
+    global dbus_connection
+    if dbus_connection is None:
+        dbus_connection = open_dbus_connection(bus='SESSION')
+    notifications = DBusAddress('/org/freedesktop/Notifications',
+                                bus_name='org.freedesktop.Notifications',
+                                interface='org.freedesktop.Notifications')
+    dbus_connection.send_and_get_reply(new_method_call(notifications, 'Notify', 'susssasa{sv}i',
+                                                       ('upnp_play', 0, '', title, message, [], {}, duration)))
 
-    Args:
-        source_file: The path of the file to be copied.
-        destination_file: The path where the file should be copied.
-    """
-    try:
-        shutil.copy2(source_file, destination_file)
-        print(f"The file '{source_file}' has been copied to '{destination_file}'")
-    except FileNotFoundError:
-        print(f"Error: the file '{source_file}' was not found.")
-    except Exception as e:
-        print(f"An error occurred during the copy: {e}")
+
+def notify_send(title, message, duration):
+    """Shows a desktop notification with the notify-send command."""
+    subprocess.run(["notify-send", title, message, "-t", str(duration)], check=True, timeout=5)
+
+
+def notify_log(title, message, duration):
+    print(f"Now playing: {title} - {message}")
+
+
+def notify_webhook(title, message, duration):
+    """Posts the notification as JSON to notification_webhook_url."""
+    response = requests.post(config.notification_webhook_url, json={'title': title, 'message': message, 'duration': duration}, timeout=2)
+    response.raise_for_status()
+
+
+def select_notification_sink(name):
+    """Returns the notification function for a notification_sink value, or None for none."""
+    if name == 'auto':
+        if DBusAddress is not None and os.environ.get('DBUS_SESSION_BUS_ADDRESS'):
+            return notify_dbus
+        if shutil.which("notify-send"):
+            return notify_send
+        return notify_log
+    if name == 'dbus' and DBusAddress is None:
+        print("Error: notification_sink = dbus needs the jeepney package, using log.")
+        return notify_log
+    return {'dbus': notify_dbus, 'notify-send': notify_send, 'log': notify_log, 'webhook': notify_webhook}.get(name)
+
+
+def notification_worker(sink):
+    while True:
+        title, message, duration = notification_queue.get()
+        try:
+            sink(title, message, duration)
+        except Exception as e:
+            print(f"Notification error ({e}), using log from now on.")
+            sink = notify_log
+            sink(title, message, duration)
+
+
+def start_notifications():
+    """Starts the notification worker for the configured sink."""
+    sink = select_notification_sink(config.notification_sink)
+    if sink is None:
+        return
+    worker = threading.Thread(target=notification_worker, args=(sink,))
+    worker.daemon = True
+    worker.start()
 
 
+def show_notification(title, artist, duration=10000):  # duration in ms
+    """Queues a notification for the track. Never blocks: dropped if the queue is full."""
+    try:
+        notification_queue.put_nowait((title, f"Artist: {artist}", duration))
+    except queue.Full:
+        pass
+
 # --- Funzioni ---
-def send_upnp_request(soap_action, xml_data):
+def send_upnp_request(soap_action, xml_data, control_url=None):
     headers = {
         'Content-Type': 'text/xml; charset=utf-8',
         'SOAPAction': f'"{soap_action}"',
     }
+    started = time.time()
     try:
-        response = requests.post(CONTROL_URL, headers=headers, data=xml_data)
+        response = requests.post(control_url or CONTROL_URL, headers=headers, data=xml_data.encode('utf-8'), timeout=config.soap_timeout)
+        capture_http('POST', control_url or CONTROL_URL, started, response, headers=headers, body=xml_data)
         response.raise_for_status() # Throws an exception for invalid HTTP status codes (4xx or 5xx)
         print(f"Request for {soap_action}")
         return response.text
     except requests.exceptions.RequestException as e:
+        if e.response is None:
+            capture_http('POST', control_url or CONTROL_URL, started, error=e, headers=headers, body=xml_data)
         print(f"Error in request for {soap_action}: {e}")
         return None
     except Exception as e:
@@ -344,77 +1032,842 @@ def parse_xml_response(xml_string, namespaces=None):
         return None, e
 
 
-# --- Web Server ---
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import os
-import mimetypes
-import socket
+# --- SCPD introspection and action invocation ---
+UPNP_SERVICE_NS = {'xmlns': 'urn:schemas-upnp-org:service-1-0'}
 
-class MyHandler(BaseHTTPRequestHandler):
-    def handle_connection_error(self, e):
-        """Silently handle connection errors without trying to send error responses"""
-        if isinstance(e, (BrokenPipeError, ConnectionResetError)):
-            # Suppress the error trace for client disconnections
-            self.close_connection = True
-            return True
-        return False
+SOAP_ENVELOPE_START = '<?xml version="1.0" encoding="utf-8"?>\n' \
+    '<s:Envelope s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/" xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body>'
+SOAP_ENVELOPE_END = '</s:Body></s:Envelope>'
 
-    def do_GET(self):
-        try:
-            filename = self.path[1:]
-            if not filename:
-                self.send_error(404, "File not specified")
-                return
-                
-            file_path = filename
-            if not os.path.exists(file_path):
-                self.send_error(404, "File not found")
-                return
+# Value ranges of the UPnP integer data types
+UPNP_INT_RANGES = {
+    'ui1': (0, 255), 'ui2': (0, 65535), 'ui4': (0, 4294967295),
+    'i1': (-128, 127), 'i2': (-32768, 32767), 'i4': (-2147483648, 2147483647), 'int': (-2147483648, 2147483647),
+}
+UPNP_FLOAT_TYPES = ('r4', 'r8', 'number', 'float', 'fixed.14.4')
+
+class ServiceDescription:
+    """
+    The actions of a service, read once from its SCPD.
+
+    The SOAP envelope of every action is precomputed as a template with one
+    slot per input argument, in the order the SCPD declares them. Without an
+    SCPD (xml_text is None) any action is accepted and its arguments are sent
+    unvalidated, in the order they are given.
+    """
+
+    def __init__(self, service_type, control_url, xml_text=None):
+        self.service_type = service_type
+        self.control_url = control_url
+        self.introspected = xml_text is not None
+        self.state_variables = {}  # name -> {'data_type', 'allowed_values', 'minimum', 'maximum'}
+        self.actions = {}  # name -> {'in': [(argument, state variable)], 'out': [argument], 'template'}
+        if xml_text is not None:
+            self.parse(xml_text)
+
+    def parse(self, xml_text):
+        root = ET.fromstring(xml_text)
+        for variable in root.findall('.//xmlns:stateVariable', UPNP_SERVICE_NS):
+            allowed_values = [value.text for value in variable.findall('xmlns:allowedValueList/xmlns:allowedValue', UPNP_SERVICE_NS)]
+            value_range = variable.find('xmlns:allowedValueRange', UPNP_SERVICE_NS)
+            self.state_variables[variable.findtext('xmlns:name', namespaces=UPNP_SERVICE_NS)] = {
+                'data_type': variable.findtext('xmlns:dataType', default='string', namespaces=UPNP_SERVICE_NS),
+                'allowed_values': allowed_values or None,
+                'minimum': value_range.findtext('xmlns:minimum', namespaces=UPNP_SERVICE_NS) if value_range is not None else None,
+                'maximum': value_range.findtext('xmlns:maximum', namespaces=UPNP_SERVICE_NS) if value_range is not None else None,
+            }
+
+        for action in root.findall('.//xmlns:action', UPNP_SERVICE_NS):
+            name = action.findtext('xmlns:name', namespaces=UPNP_SERVICE_NS)
+            in_args = []
+            out_args = []
+            for argument in action.findall('xmlns:argumentList/xmlns:argument', UPNP_SERVICE_NS):
+                argument_name = argument.findtext('xmlns:name', namespaces=UPNP_SERVICE_NS)
+                if argument.findtext('xmlns:direction', namespaces=UPNP_SERVICE_NS) == 'in':
+                    in_args.append((argument_name, argument.findtext('xmlns:relatedStateVariable', namespaces=UPNP_SERVICE_NS)))
+                else:
+                    out_args.append(argument_name)
+            self.actions[name] = {
+                'in': in_args,
+                'out': out_args,
+                'template': self.build_template(name, [argument_name for argument_name, _ in in_args]),
+            }
+
+    def build_template(self, action, argument_names):
+        """Returns the SOAP envelope of an action with a {n} slot for each argument."""
+        body = ''.join(f"<{argument_name}>{{{i}}}</{argument_name}>" for i, argument_name in enumerate(argument_names))
+        return (f'{SOAP_ENVELOPE_START}<u:{action} xmlns:u="{self.service_type}">'.replace('{', '{{').replace('}', '}}')
+                + body + f'</u:{action}>{SOAP_ENVELOPE_END}')
+
+    def validate(self, argument_name, state_variable, value):
+        """
+        Checks a value against the state variable of its argument.
+
+        Returns:
+            The value as sent on the wire.
 
+        Raises:
+            ValueError: If the value is not allowed.
+        """
+        variable = self.state_variables.get(state_variable, {})
+        data_type = variable.get('data_type', 'string')
+        if isinstance(value, bool) or data_type == 'boolean':
+            if str(value).lower() not in ('0', '1', 'true', 'false', 'yes', 'no'):
+                raise ValueError(f"{argument_name} must be a boolean, got {value!r}")
+            return '1' if str(value).lower() in ('1', 'true', 'yes') else '0'
+        if data_type in UPNP_INT_RANGES or data_type in UPNP_FLOAT_TYPES:
             try:
-                with open(file_path, "rb") as f:
-                    self.send_response(200)
-                    # Determine the Content-type based on the file extension
-                    content_type, _ = mimetypes.guess_type(file_path)
-                    if content_type is None:
-                        content_type = 'application/octet-stream'
-                    self.send_header('Content-type', content_type)
-                    self.end_headers()
-                    
-                    chunk_size = 1024 * 64
-                    while True:
-                        chunk = f.read(chunk_size)
-                        if not chunk:
-                            break
-                        try:
-                            self.wfile.write(chunk)
-                        except (BrokenPipeError, ConnectionResetError) as e:
-                            # Client disconnected - stop sending data
-                            self.handle_connection_error(e)
-                            return
-                        
-            except Exception as e:
-                if not self.handle_connection_error(e):
-                    self.send_error(500, f"Error serving file: {str(e)}")
-                    
-        except Exception as e:
-            if not self.handle_connection_error(e):
-                self.send_error(500, f"Internal server error: {str(e)}")
+                number = int(value) if data_type in UPNP_INT_RANGES else float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{argument_name} must be a {data_type} number, got {value!r}")
+            low, high = UPNP_INT_RANGES.get(data_type, (None, None))
+            bound = int if data_type in UPNP_INT_RANGES else float
+            if variable.get('minimum') is not None:
+                low = bound(variable['minimum'])
+            if variable.get('maximum') is not None:
+                high = bound(variable['maximum'])
+            if (low is not None and number < low) or (high is not None and number > high):
+                raise ValueError(f"{argument_name} must be between {low} and {high}, got {number}")
+            return str(number)
+        value = str(value)
+        if variable.get('allowed_values') and value not in variable['allowed_values']:
+            raise ValueError(f"{argument_name} must be one of {', '.join(variable['allowed_values'])}, got {value!r}")
+        return value
 
-    def do_HEAD(self):
-        try:
-            filename = self.path[1:]
-            if not filename:
-                self.send_error(404, "File not specified")
+    def envelope(self, action, args):
+        """
+        Returns the SOAP envelope of an action call.
+
+        InstanceID defaults to 0 when the action takes one.
+
+        Raises:
+            ValueError: If the action is unknown or an argument is missing or invalid.
+        """
+        if not self.introspected:
+            args = dict({'InstanceID': 0}, **args)
+            template = self.build_template(action, list(args))
+            return template.format(*(escape(str(value)) for value in args.values()))
+
+        if action not in self.actions:
+            raise ValueError(f"{self.service_type} has no action {action}")
+        spec = self.actions[action]
+        known = {argument_name for argument_name, _ in spec['in']}
+        unknown = set(args) - known
+        if unknown:
+            raise ValueError(f"Unknown arguments for {action}: {', '.join(sorted(unknown))}")
+        values = []
+        for argument_name, state_variable in spec['in']:
+            if argument_name not in args:
+                if argument_name != 'InstanceID':
+                    raise ValueError(f"Missing argument {argument_name} for {action}")
+                args[argument_name] = 0
+            values.append(escape(self.validate(argument_name, state_variable, args[argument_name])))
+        return spec['template'].format(*values)
+
+
+# SCPDs of the selected renderer by service name
+service_cache = {}
+
+def get_service_description(service_name):
+    """
+    Returns the ServiceDescription of a service of the selected renderer.
+
+    The SCPD is fetched once. If it cannot be fetched, a ServiceDescription
+    without validation is returned so that control keeps working.
+
+    Returns:
+        The ServiceDescription, or None if the renderer has no such service.
+    """
+    if service_name in service_cache:
+        return service_cache[service_name]
+
+    description = get_device_description(RENDERER_LOCATION) if RENDERER_LOCATION else None
+    service = description.find_service(service_name) if description else None
+    if service is None or not service['control_url']:
+        if service_name != 'AVTransport' or not CONTROL_URL:
+            print(f"Service {service_name} not available on the renderer.")
+            return None
+        service = {'service_type': "urn:schemas-upnp-org:service:AVTransport:1", 'control_url': CONTROL_URL, 'scpd_url': None}
+
+    service_description = None
+    if service['scpd_url']:
+        started = time.time()
+        try:
+            response = requests.get(service['scpd_url'], timeout=config.http_timeout)
+            capture_http('GET', service['scpd_url'], started, response)
+            response.raise_for_status()
+            service_description = ServiceDescription(service['service_type'], service['control_url'], response.content)
+        except requests.exceptions.RequestException as e:
+            if e.response is None:
+                capture_http('GET', service['scpd_url'], started, error=e)
+            print(f"Error during request to {service['scpd_url']}: {e}")
+        except ET.ParseError as e:
+            print(f"Error parsing SCPD of {service_name}: {e}")
+    if service_description is None:
+        service_description = ServiceDescription(service['service_type'], service['control_url'])
+
+    service_cache[service_name] = service_description
+    return service_description
+
+
+def parse_action_response(response_text, action):
+    """Returns the output arguments of a SOAP action response as a dict."""
+    root, error = parse_xml_response(response_text)
+    if root is None:
+        return None
+    for element in root.iter():
+        if isinstance(element.tag, str) and etree.QName(element).localname == action + "Response":
+            return {etree.QName(child).localname: child.text or '' for child in element if isinstance(child.tag, str)}
+    print(f"No {action}Response in the response")
+    return None
+
+
+def invoke(service_name, action, **args):
+    """
+    Invokes an action of a service of the selected renderer.
+
+    The arguments are validated against the SCPD before anything is sent.
+
+    Args:
+        service_name: The service name, e.g. "AVTransport" or "RenderingControl".
+        action: The action name, e.g. "Seek".
+        **args: The input arguments of the action.
+
+    Returns:
+        A dict with the output arguments, or None on error.
+    """
+    service = get_service_description(service_name)
+    if service is None:
+        return None
+    try:
+        xml_data = service.envelope(action, args)
+    except ValueError as e:
+        print(f"Invalid call to {service_name}#{action}: {e}")
+        return None
+    response_text = send_upnp_request(f"{service.service_type}#{action}", xml_data, service.control_url)
+    if response_text is None:
+        return None
+    return parse_action_response(response_text, action)
+
+
+# --- GENA events ---
+# Seconds asked for when subscribing to renderer events
+EVENT_SUBSCRIPTION_TIMEOUT = 1800
+
+# Event callbacks by callback path, called with a dict of the changed state variables
+event_handlers = {}
+# Subscription URL in use by service name, renewals for another URL are dropped
+event_subscriptions = {}
+
+def local_name(tag):
+    """Returns an XML tag without its namespace."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_event_body(body):
+    """
+    Parses the propertyset of a GENA NOTIFY.
+
+    LastChange is expanded into the variables of InstanceID 0; for variables
+    with a channel only the Master channel is kept.
+
+    Returns:
+        A dict of state variable names to values.
+    """
+    variables = {}
+    for prop in ET.fromstring(body):
+        for variable in prop:
+            name = local_name(variable.tag)
+            if name != 'LastChange':
+                variables[name] = variable.text or ''
+                continue
+            event = ET.fromstring(variable.text or '')
+            for instance in event:
+                if instance.get('val', '0') != '0':
+                    continue
+                for change in instance:
+                    if change.get('channel', 'Master') == 'Master':
+                        variables[local_name(change.tag)] = change.get('val', '')
+    return variables
+
+
+def subscribe_events(service_name, callback):
+    """
+    Subscribes to the events of a renderer service and keeps the subscription renewed.
+
+    Returns:
+        True if the subscription succeeded.
+    """
+    description = get_device_description(RENDERER_LOCATION) if RENDERER_LOCATION else None
+    service = description.find_service(service_name) if description else None
+    if service is None or not service['event_sub_url']:
+        print(f"Events of {service_name} not available on the renderer.")
+        return False
+
+    path = f"/events/{service_name}"
+    event_handlers[path] = callback
+    event_subscriptions[service_name] = service['event_sub_url']
+    headers = {
+        'CALLBACK': f"<http://{url_host(ip_address)}:{config.SERVER_PORT}{path}>",
+        'NT': 'upnp:event',
+        'TIMEOUT': f"Second-{EVENT_SUBSCRIPTION_TIMEOUT}",
+    }
+    return send_subscription(service_name, service['event_sub_url'], headers, callback)
+
+
+def send_subscription(service_name, url, headers, callback):
+    """Sends SUBSCRIBE (new or renewal) and schedules the next renewal."""
+    if event_subscriptions.get(service_name) != url:
+        # Subscribed again since, e.g. to a renderer that moved
+        return False
+    try:
+        response = requests.request('SUBSCRIBE', url, headers=headers, timeout=config.http_timeout)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Error subscribing to {service_name} events: {e}")
+        if 'SID' in headers:
+            # The renderer forgot the subscription, start a new one
+            return subscribe_events(service_name, callback)
+        return False
+
+    sid = response.headers.get('SID')
+    match = re.search(r"Second-(\d+)", response.headers.get('TIMEOUT', ''), re.IGNORECASE)
+    timeout = int(match.group(1)) if match else EVENT_SUBSCRIPTION_TIMEOUT
+    renew_headers = {'SID': sid, 'TIMEOUT': f"Second-{EVENT_SUBSCRIPTION_TIMEOUT}"}
+    timer = threading.Timer(timeout * 0.8, send_subscription, args=(service_name, url, renew_headers, callback))
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+# --- RenderingControl volume ---
+class VolumeController:
+    """
+    Volume and mute of the renderer through RenderingControl.
+
+    set_volume() and set_mute() only record the wanted value. A worker thread
+    sends the latest one at most once per interval, so key repeats collapse
+    into a single SOAP request. The current state is kept up to date from
+    LastChange events instead of polling.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.volume = None
+        self.mute = None
+        self.pending_volume = None
+        self.pending_mute = None
+        # Last values asked for, sent or not: the base for relative changes
+        self.requested_volume = None
+        self.requested_mute = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+
+    def start(self):
+        """Starts the worker thread and subscribes to RenderingControl events."""
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+        subscribe_events("RenderingControl", self.on_event)
+
+    def reset(self):
+        """Forgets what is known of the renderer, e.g. after switching to another one."""
+        with self.lock:
+            self.volume = None
+            self.mute = None
+            self.requested_volume = None
+            self.requested_mute = None
+
+    def get_volume(self):
+        """Returns the current volume, asking the renderer only if no event reported it yet."""
+        if self.volume is None:
+            result = invoke("RenderingControl", "GetVolume", Channel="Master")
+            if result is not None and result.get('CurrentVolume', '').isdigit():
+                self.volume = int(result['CurrentVolume'])
+        return self.volume
+
+    def get_mute(self):
+        """Returns the current mute state, asking the renderer only if no event reported it yet."""
+        if self.mute is None:
+            result = invoke("RenderingControl", "GetMute", Channel="Master")
+            if result is not None:
+                self.mute = result.get('CurrentMute') in ('1', 'true')
+        return self.mute
+
+    def set_volume(self, volume):
+        with self.lock:
+            self.pending_volume = max(0, min(100, int(volume)))
+            self.requested_volume = self.pending_volume
+        self.wake.set()
+
+    def change_volume(self, delta):
+        with self.lock:
+            base = self.requested_volume
+        if base is None:
+            base = self.get_volume()
+        if base is None:
+            print("Volume not available on the renderer.")
+            return
+        self.set_volume(base + delta)
+
+    def set_mute(self, mute):
+        with self.lock:
+            self.pending_mute = bool(mute)
+            self.requested_mute = self.pending_mute
+        self.wake.set()
+
+    def toggle_mute(self):
+        with self.lock:
+            current = self.requested_mute
+        if current is None:
+            current = self.get_mute()
+        self.set_mute(not current)
+
+    def run(self):
+        while True:
+            self.wake.wait()
+            self.wake.clear()
+            with self.lock:
+                volume, self.pending_volume = self.pending_volume, None
+                mute, self.pending_mute = self.pending_mute, None
+
+            if volume is not None and volume != self.volume:
+                if invoke("RenderingControl", "SetVolume", Channel="Master", DesiredVolume=volume) is not None:
+                    self.volume = volume
+                    print(f"Volume: {volume}")
+            if mute is not None and mute != self.mute:
+                if invoke("RenderingControl", "SetMute", Channel="Master", DesiredMute=mute) is not None:
+                    self.mute = mute
+                    print(f"Mute: {mute}")
+            # Changes requested meanwhile are sent together after the interval
+            time.sleep(self.interval)
+
+    def on_event(self, variables):
+        with self.lock:
+            if variables.get('Volume', '').isdigit():
+                self.volume = int(variables['Volume'])
+                if self.pending_volume is None:
+                    # Changed on the renderer itself, e.g. with the TV remote
+                    self.requested_volume = None
+            if 'Mute' in variables:
+                self.mute = variables['Mute'] in ('1', 'true')
+                if self.pending_mute is None:
+                    self.requested_mute = None
+
+
+# --- Content table ---
+# Only items registered here are served: id -> {'path', 'size', 'mime', 'mtime'}
+content_table = {}
+content_table_lock = threading.Lock()
+
+def register_content(file_path, content_id=None, mime=None, caption_url=None):
+    """
+    Registers a file in the content table so that the web server can serve it.
+    Beyond content_table_size entries, the oldest generated ids are dropped.
+
+    Args:
+        file_path: The path of the file on disk.
+        content_id: The id to publish the file under. If None, a stable id is
+            derived from the absolute path, keeping the original extension.
+            Files registered with an explicit id are never dropped.
+        mime: The Content-Type to serve the file with. If None, it is guessed
+            from the extension.
+        caption_url: The URL of the subtitles of a video, returned to renderers
+            asking for it with the getCaptionInfo.sec header.
+
+    Returns:
+        The content id, or None if the file cannot be read.
+    """
+    try:
+        stat_result = os.stat(file_path)
+    except OSError as e:
+        print(f"Error registering {file_path}: {e}")
+        return None
+
+    explicit_id = content_id is not None
+    if content_id is None:
+        digest = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16]
+        content_id = digest + os.path.splitext(file_path)[1].lower()
+
+    if mime is None:
+        mime, _ = mimetypes.guess_type(file_path)
+    with content_table_lock:
+        # Re-registering moves the entry to the end of the eviction order
+        pinned = content_table.pop(content_id, {}).get('pinned', False) or explicit_id
+        content_table[content_id] = {
+            'path': file_path,
+            'size': stat_result.st_size,
+            'mime': mime or 'application/octet-stream',
+            'mtime': stat_result.st_mtime,
+            'caption_url': caption_url,
+            'pinned': pinned,
+        }
+        evict_content()
+    return content_id
+
+def evict_content():
+    """Drops the oldest unpinned entries beyond content_table_size. Called with content_table_lock held."""
+    excess = len(content_table) - config.content_table_size
+    if excess <= 0:
+        return
+    for content_id in list(content_table):
+        if excess <= 0:
+            break
+        if content_table[content_id].get('pinned') or content_id == playing_content_id:
+            continue
+        del content_table[content_id]
+        excess -= 1
+
+def lookup_content(request_path):
+    """
+    Returns the content table entry for a request path, or None if the id is unknown.
+    "/<id>/<member>" paths address the playlist and segments of an HLS entry.
+    """
+    content_id, _, member = request_path.split('?', 1)[0].lstrip('/').partition('/')
+    entry = content_table.get(content_id)
+    if entry is not None and entry.get('hls') is not None:
+        return entry['hls'].member_entry(member or 'index.m3u8')
+    if member:
+        return None
+    return entry
+
+
+# --- Bandwidth shaping ---
+MIN_SEND_CHUNK_SIZE = 1024 * 16
+
+
+class TokenBucket:
+    """
+    Limits a byte rate shared by several threads. A rate of 0 means unlimited.
+
+    take() reserves the bytes right away and returns how long the caller has to
+    wait before sending them, so concurrent streams are served in turn.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount):
+        """Reserves amount bytes and returns the delay in seconds before they may be sent."""
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            # At most one second of unused rate can be spent as a burst
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+class ThroughputMeter:
+    """Counts the bytes sent by a class of streams, for the gauges served on /metrics."""
+
+    WINDOW = 5
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total = 0
+        self.active = 0
+        # [second, bytes] for the last WINDOW seconds
+        self.seconds = deque()
+
+    def start(self):
+        with self.lock:
+            self.active += 1
+
+    def stop(self):
+        with self.lock:
+            self.active -= 1
+
+    def add(self, amount):
+        second = int(time.monotonic())
+        with self.lock:
+            self.total += amount
+            if self.seconds and self.seconds[-1][0] == second:
+                self.seconds[-1][1] += amount
+            else:
+                self.seconds.append([second, amount])
+            while self.seconds[0][0] <= second - self.WINDOW:
+                self.seconds.popleft()
+
+    def rate(self):
+        """Returns the bytes per second sent over the last WINDOW seconds."""
+        now = int(time.monotonic())
+        with self.lock:
+            return sum(amount for second, amount in self.seconds if second > now - self.WINDOW) / self.WINDOW
+
+
+global_bucket = TokenBucket(config.max_rate)
+background_bucket = TokenBucket(config.background_rate)
+throughput = {'playing': ThroughputMeter(), 'background': ThroughputMeter()}
+# Content id of the file the renderer is playing, its stream has priority
+playing_content_id = None
+
+
+def set_playing_content(uri):
+    """Gives priority to the stream of uri over album art and other requests."""
+    global playing_content_id
+    playing_content_id = urlparse(uri).path.lstrip('/').partition('/')[0]
+
+
+def is_playing_content(request_path):
+    return request_path.split('?', 1)[0].lstrip('/').partition('/')[0] == playing_content_id
+
+
+def format_metrics():
+    """Returns the throughput gauges in the Prometheus text format."""
+    lines = [
+        "# HELP upnp_play_throughput_bytes Bytes per second sent over the last 5 seconds.",
+        "# TYPE upnp_play_throughput_bytes gauge",
+    ]
+    lines += [f'upnp_play_throughput_bytes{{stream="{name}"}} {meter.rate():.1f}' for name, meter in throughput.items()]
+    lines += ["# HELP upnp_play_active_streams Responses being sent.", "# TYPE upnp_play_active_streams gauge"]
+    lines += [f'upnp_play_active_streams{{stream="{name}"}} {meter.active}' for name, meter in throughput.items()]
+    lines += ["# HELP upnp_play_sent_bytes_total Bytes sent since start.", "# TYPE upnp_play_sent_bytes_total counter"]
+    lines += [f'upnp_play_sent_bytes_total{{stream="{name}"}} {meter.total}' for name, meter in throughput.items()]
+    return "\n".join(lines) + "\n"
+
+
+# --- Web Server ---
+from http.server import BaseHTTPRequestHandler
+import os
+import mimetypes
+import socket
+
+class MyHandler(BaseHTTPRequestHandler):
+    def setup(self):
+        super().setup()
+        # Don't let Nagle hold back the small header segment
+        try:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+
+    def handle_connection_error(self, e):
+        """Silently handle connection errors without trying to send error responses"""
+        if isinstance(e, (BrokenPipeError, ConnectionResetError)):
+            # Suppress the error trace for client disconnections
+            self.close_connection = True
+            return True
+        return False
+
+    def set_cork(self, enabled):
+        """Sets TCP_CORK (Linux only) so headers and body leave in full-sized segments."""
+        if hasattr(socket, 'TCP_CORK'):
+            try:
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if enabled else 0)
+            except OSError:
+                pass
+
+    def parse_range(self, file_size):
+        """
+        Parses a single "bytes=start-end" Range header.
+
+        Returns:
+            A (start, end) tuple with inclusive offsets, or None if the request
+            has no usable Range header.
+
+        Raises:
+            ValueError: If the range cannot be satisfied.
+        """
+        range_header = self.headers.get('Range')
+        if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+            return None
+        start_str, _, end_str = range_header[6:].strip().partition('-')
+        try:
+            if start_str:
+                start = int(start_str)
+                end = int(end_str) if end_str else file_size - 1
+            else:
+                # Suffix range: the last N bytes
+                start = max(0, file_size - int(end_str))
+                end = file_size - 1
+        except ValueError:
+            return None
+        end = min(end, file_size - 1)
+        if start > end:
+            raise ValueError(f"Unsatisfiable range {range_header}")
+        return start, end
+
+    def entry_headers(self, entry):
+        """Returns the validators and DLNA headers sent with a content table entry."""
+        headers = [
+            ('ETag', f'"{int(entry["mtime"])}-{entry["size"]}"'),
+            ('Last-Modified', self.date_time_string(entry['mtime'])),
+        ]
+        if entry.get('caption_url') and self.headers.get('getCaptionInfo.sec'):
+            headers.append(('CaptionInfo.sec', entry['caption_url']))
+        return headers
+
+    def throttle(self, amount, priority, connection_bucket):
+        """Waits until amount bytes may be sent under the global and per-connection limits."""
+        buckets = [global_bucket, connection_bucket]
+        # Other requests only get background_rate while the playing file is streamed
+        if not priority and throughput['playing'].active:
+            buckets.append(background_bucket)
+        delay = max(bucket.take(amount) for bucket in buckets)
+        if delay:
+            time.sleep(delay)
+
+    def response_head(self, code, headers):
+        """
+        Returns the status line and headers of a response as bytes.
+
+        Built here rather than with send_response()/send_header(), whose
+        buffer can only be flushed on its own, so they can go out in the same
+        sendall() as the first body bytes.
+        """
+        self.log_request(code)
+        lines = [f"{self.protocol_version} {code} {self.responses[code][0]}",
+                 f"Server: {self.version_string()}",
+                 f"Date: {self.date_time_string()}"]
+        lines += [f"{name}: {value}" for name, value in headers]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1', 'strict')
+
+    def send_file_fast(self, f, content_type, file_size, byte_range=None, extra_headers=()):
+        """
+        Sends the response for an open file using the fast path.
+
+        The status line, the headers and the first body bytes are written with a
+        single sendall(), the remainder of the file goes through socket.sendfile()
+        so the data never passes through Python. The file is sent in chunks that
+        are paced by the max_rate, connection_rate and background_rate limits.
+
+        Args:
+            f: The file object opened in binary mode.
+            content_type: The value for the Content-type header.
+            file_size: The size of the file in bytes.
+            byte_range: An optional (start, end) tuple from parse_range().
+            extra_headers: Additional (name, value) headers.
+
+        Returns:
+            The number of body bytes sent.
+        """
+        headers = []
+        if byte_range:
+            start, end = byte_range
+            code = 206
+            headers.append(('Content-Range', f"bytes {start}-{end}/{file_size}"))
+        else:
+            start, end = 0, file_size - 1
+            code = 200
+        length = end - start + 1
+        headers += [('Content-type', content_type), ('Content-Length', str(length)), ('Accept-Ranges', 'bytes')]
+        headers += extra_headers
+        head = self.response_head(code, headers)
+        f.seek(start)
+        first_chunk = f.read(min(config.first_chunk_size, length))
+
+        priority = is_playing_content(self.path)
+        meter = throughput['playing' if priority else 'background']
+        connection_bucket = TokenBucket(config.connection_rate)
+        # Small chunks at low rates, so the stream is paced rather than bursty
+        rates = [rate for rate in (config.max_rate, config.connection_rate, 0 if priority else config.background_rate) if rate]
+        chunk_size = max(MIN_SEND_CHUNK_SIZE, min(config.send_chunk_size, min(rates) // 10)) if rates else config.send_chunk_size
+
+        meter.start()
+        self.set_cork(True)
+        try:
+            self.throttle(len(first_chunk), priority, connection_bucket)
+            self.connection.sendall(head + first_chunk)
+            sent = len(first_chunk)
+            meter.add(sent)
+            while sent < length:
+                count = min(chunk_size, length - sent)
+                self.throttle(count, priority, connection_bucket)
+                count = self.connection.sendfile(f, offset=start + sent, count=count)
+                if not count:
+                    # The file was truncated while being served
+                    break
+                sent += count
+                meter.add(count)
+        finally:
+            self.set_cork(False)
+            meter.stop()
+        return sent
+
+    def send_metrics(self):
+        body = format_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        try:
+            if self.path.split('?', 1)[0] == '/metrics':
+                self.send_metrics()
                 return
-                
-            file_path = filename
-            if os.path.exists(file_path):
+            entry = lookup_content(self.path)
+            if entry is None:
+                self.send_error(404, "File not found")
+                return
+
+            file_path = entry['path']
+            headers = self.entry_headers(entry)
+            if self.headers.get('If-None-Match') == dict(headers)['ETag']:
+                self.send_response(304)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.end_headers()
+                return
+            try:
+                try:
+                    byte_range = self.parse_range(entry['size'])
+                except ValueError:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f"bytes */{entry['size']}")
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                with open(file_path, "rb") as f:
+                    try:
+                        self.send_file_fast(f, entry['mime'], entry['size'], byte_range, headers)
+                    except (BrokenPipeError, ConnectionResetError) as e:
+                        # Client disconnected - stop sending data
+                        self.handle_connection_error(e)
+                        return
+
+            except Exception as e:
+                if not self.handle_connection_error(e):
+                    self.send_error(500, f"Error serving file: {str(e)}")
+                    
+        except Exception as e:
+            if not self.handle_connection_error(e):
+                self.send_error(500, f"Internal server error: {str(e)}")
+
+    def do_NOTIFY(self):
+        """Receives GENA events from the renderer."""
+        callback = event_handlers.get(self.path.split('?', 1)[0])
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if callback is None:
+            self.send_error(412, "Unknown subscription")
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        try:
+            callback(parse_event_body(body))
+        except ET.ParseError as e:
+            print(f"Error parsing event: {e}")
+
+    def do_HEAD(self):
+        try:
+            entry = lookup_content(self.path)
+            if entry is not None:
                 self.send_response(200)
-                content_type, _ = mimetypes.guess_type(file_path)
-                if content_type is None:
-                    content_type = 'application/octet-stream'
-                self.send_header('Content-type', content_type)
+                self.send_header('Content-type', entry['mime'])
+                self.send_header('Content-Length', str(entry['size']))
+                self.send_header('Accept-Ranges', 'bytes')
+                for name, value in self.entry_headers(entry):
+                    self.send_header(name, value)
                 self.end_headers()
             else:
                 self.send_error(404, "File not found")
@@ -423,243 +1876,2343 @@ class MyHandler(BaseHTTPRequestHandler):
             if not self.handle_connection_error(e):
                 self.send_error(500, "Internal server error")
 
-def run_web_server(port):
-    server_address = ('', port)
-    httpd = HTTPServer(server_address, MyHandler)
-    print(f"Web server running on port {port}...")
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer handling at most server_threads requests at a time, the others wait to be accepted."""
+
+    def __init__(self, *args, **kwargs):
+        self.slots = threading.BoundedSemaphore(config.server_threads)
+        super().__init__(*args, **kwargs)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.slots.release()
+
+class DualStackHTTPServer(BoundedThreadingHTTPServer):
+    """HTTPServer listening on IPv6 and, through mapped addresses, on IPv4."""
+    address_family = socket.AF_INET6
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        super().server_bind()
+
+def run_web_server(port):
+    httpd = None
+    if config.use_ipv6 and socket.has_ipv6:
+        try:
+            httpd = DualStackHTTPServer(('::', port), MyHandler)
+        except OSError as e:
+            print(f"IPv6 web server not available ({e}), using IPv4 only.")
+    if httpd is None:
+        httpd = BoundedThreadingHTTPServer(('', port), MyHandler)
+    print(f"Web server running on port {port}...")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Server shutdown...")
+        httpd.server_close()
+    except Exception as e:
+        print(f"Critical Server Error: {e}")
+        httpd.server_close()
+
+
+# --- Position info and resume state ---
+def get_position_info():
+    """
+    Sends GetPositionInfo and returns the position fields of the response.
+
+    Returns:
+        A dict with TrackDuration, RelTime and TrackURI (strings as sent by
+        the renderer), or None on error.
+    """
+    position_info = invoke("AVTransport", "GetPositionInfo")
+    if position_info is None:
+        return None
+    return {tag: position_info.get(tag) or None for tag in ('TrackDuration', 'RelTime', 'TrackURI')}
+
+
+def parse_time(time_str):
+    """Converts an H+:MM:SS[.F] time string to seconds. Returns None for missing or invalid values."""
+    if not time_str or time_str == "NOT_IMPLEMENTED":
+        return None
+    try:
+        hours, minutes, seconds = time_str.split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return None
+
+
+def format_time(seconds):
+    """Converts seconds to the H:MM:SS format used by AVTransport."""
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def save_resume_state(filename, rel_time):
+    """Writes the current track and position to the resume state file."""
+    if not config.resume_playback:
+        return
+    temp_file = config.resume_state_file + ".tmp"
+    try:
+        with open(temp_file, "w", encoding='utf-8') as f:
+            json.dump({'filename': filename, 'rel_time': rel_time, 'saved': time.time()}, f)
+        os.replace(temp_file, config.resume_state_file)
+    except OSError as e:
+        print(f"Error writing resume state {config.resume_state_file}: {e}")
+
+
+def load_resume_state():
+    """Returns the saved resume state dict, or None if there is nothing to resume."""
+    if not config.resume_playback or not os.path.exists(config.resume_state_file):
+        return None
+    try:
+        with open(config.resume_state_file, encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('filename'):
+            return state
+    except (OSError, ValueError) as e:
+        print(f"Error reading resume state {config.resume_state_file}: {e}")
+    return None
+
+
+def clear_resume_state():
+    """Removes the resume state file once the queue has been played to the end."""
+    try:
+        os.remove(config.resume_state_file)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"Error removing resume state {config.resume_state_file}: {e}")
+
+
+class PositionTracker:
+    """
+    Tracks the playback position from sparse GetPositionInfo polls.
+
+    Between polls the position is extrapolated from the last RelTime sample,
+    which gives the predicted end of the track. Polls are scheduled around
+    that prediction instead of at a fixed rate.
+    """
+
+    # Seconds to wait after the predicted end before checking the transport state
+    END_GRACE = 0.5
+
+    def __init__(self, poll_interval, min_poll_interval, sync_interval):
+        self.poll_interval = poll_interval
+        self.min_poll_interval = min_poll_interval
+        self.sync_interval = sync_interval
+        self.duration = None
+        self.rel_time = None
+        self.sampled_at = None
+        self.playing = True
+        self.last_sync = None
+        self.sync_count = 0
+        self.end_synced = False
+
+    def update(self, position, now):
+        """Stores a GetPositionInfo result sampled at time now."""
+        self.duration = parse_time(position.get('TrackDuration')) or None
+        rel_time = parse_time(position.get('RelTime'))
+        if rel_time is not None:
+            self.rel_time = rel_time
+            self.sampled_at = now
+        self.last_sync = now
+        self.sync_count += 1
+        remaining = self.remaining(now)
+        if remaining is not None and remaining <= self.poll_interval:
+            self.end_synced = True
+
+    def set_playing(self, playing, now):
+        """Freezes or restarts the extrapolation when the transport state changes."""
+        if playing == self.playing:
+            return
+        if self.rel_time is not None:
+            self.rel_time = self.position(now)
+            self.sampled_at = now
+        self.playing = playing
+
+    def position(self, now):
+        """Returns the predicted position in seconds, or None if unknown."""
+        if self.rel_time is None:
+            return None
+        if not self.playing:
+            return self.rel_time
+        return self.rel_time + (now - self.sampled_at)
+
+    def remaining(self, now):
+        """Returns the predicted seconds left in the track, or None if unknown."""
+        position = self.position(now)
+        if position is None or self.duration is None:
+            return None
+        return max(0.0, self.duration - position)
+
+    def needs_sync(self, now):
+        """Returns True if the position should be refreshed with GetPositionInfo."""
+        if self.last_sync is None:
+            return True
+        age = now - self.last_sync
+        if self.duration is None:
+            # The renderer may not know the duration right after Play
+            return age >= (self.poll_interval if self.sync_count < 3 else self.sync_interval)
+        remaining = self.remaining(now)
+        if not self.end_synced and remaining is not None and remaining <= self.poll_interval:
+            # One more sample close to the end corrects the drift of the prediction
+            return True
+        return age >= self.sync_interval
+
+    def next_poll_delay(self, now, prepare_ahead=None):
+        """Returns the seconds to wait before the next poll."""
+        remaining = self.remaining(now)
+        if remaining is None or not self.playing:
+            return self.poll_interval
+        delays = [self.poll_interval, remaining + self.END_GRACE]
+        if not self.end_synced:
+            delays.append(remaining - self.poll_interval)
+        if prepare_ahead and remaining > prepare_ahead:
+            delays.append(remaining - prepare_ahead)
+        return max(self.min_poll_interval, min(delays))
+
+
+# --- Renderer quirks ---
+# What every renderer gets unless a profile of quirks_file says otherwise:
+# the Stop / SetAVTransportURI / Play sequence with the waits a slow TV box needs
+DEFAULT_QUIRKS = {
+    'stop_before_load': True,   # Send Stop before SetAVTransportURI
+    'wait_after_stop': 1,       # Seconds to wait after Stop
+    'wait_after_load': 1,       # Seconds to wait after SetAVTransportURI
+    'wait_after_play': 5,       # Seconds to wait after Play before seeking or polling
+    'set_next': False,          # Queue the next track with SetNextAVTransportURI (gapless)
+    'seek_unit': 'REL_TIME',    # Seek unit used to resume, 'none' if the renderer cannot seek
+    'mime_types': None,         # MIME types the renderer plays, None to send everything
+}
+SEEK_UNITS = ('REL_TIME', 'ABS_TIME', 'none')
+# The fields of the renderer a profile can match, with the SERVER header of its SSDP messages
+QUIRK_MATCH_FIELDS = ('server', 'friendly_name', 'manufacturer', 'model_name', 'model_number')
+
+# Quirks of the current renderer and the MIME types of its GetProtocolInfo Sink
+quirks = dict(DEFAULT_QUIRKS)
+sink_mime_types = None
+
+
+def valid_quirk(name, value):
+    """Returns True if value is a valid setting for the quirk name."""
+    if name in ('stop_before_load', 'set_next'):
+        return isinstance(value, bool)
+    if name.startswith('wait_'):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and value >= 0
+    if name == 'seek_unit':
+        return value in SEEK_UNITS
+    if name == 'mime_types':
+        return value is None or (isinstance(value, list) and all(isinstance(mime, str) for mime in value))
+    return False
+
+
+def load_quirks_profiles(path):
+    """
+    Reads the renderer profiles of a quirks file.
+
+    The file is a JSON list of profiles, each with a name, a match object of
+    regular expressions over QUIRK_MATCH_FIELDS and the quirks it sets.
+    Invalid profiles and settings are reported and skipped.
+    """
+    if not path:
+        return []
+    try:
+        with open(path, encoding='utf-8') as f:
+            profiles = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error reading renderer quirks {path}: {e}")
+        return []
+    if not isinstance(profiles, list):
+        print(f"Error in renderer quirks {path}: expected a list of profiles")
+        return []
+
+    valid_profiles = []
+    for profile in profiles:
+        if not isinstance(profile, dict) or not isinstance(profile.get('match'), dict):
+            print(f"Renderer quirks: skipping profile without a match object: {profile}")
+            continue
+        name = profile.get('name', '?')
+        try:
+            match = {field: re.compile(pattern, re.IGNORECASE) for field, pattern in profile['match'].items()
+                     if field in QUIRK_MATCH_FIELDS}
+        except (re.error, TypeError) as e:
+            print(f"Renderer quirks: invalid match in profile {name}: {e}")
+            continue
+        settings = {}
+        for key, value in profile.items():
+            if key in ('name', 'match'):
+                continue
+            if key in DEFAULT_QUIRKS and valid_quirk(key, value):
+                settings[key] = value
+            else:
+                print(f"Renderer quirks: ignoring {key}={value!r} in profile {name}")
+        valid_profiles.append({'name': name, 'match': match, 'quirks': settings})
+    return valid_profiles
+
+
+def renderer_quirks(fields, profiles):
+    """
+    Returns the quirks of a renderer and the names of the profiles that set them.
+
+    Every profile whose patterns all match is applied, in file order, so a
+    later profile can refine an earlier, more general one.
+    """
+    result = dict(DEFAULT_QUIRKS)
+    names = []
+    for profile in profiles:
+        if profile['match'] and all(pattern.search(fields.get(field) or '') for field, pattern in profile['match'].items()):
+            result.update(profile['quirks'])
+            names.append(profile['name'])
+    return result, names
+
+
+def parse_protocol_info(protocol_info):
+    """Returns the MIME types of a comma separated list of protocolInfo strings (as in GetProtocolInfo)."""
+    mime_types = set()
+    for entry in (protocol_info or '').split(','):
+        parts = entry.strip().split(':')
+        if len(parts) == 4 and parts[0] == 'http-get' and parts[2] != '*':
+            mime_types.add(parts[2].lower())
+    return mime_types
+
+
+def apply_renderer_quirks(location):
+    """
+    Looks up the quirks of the renderer at location and makes them the current ones.
+
+    Called once the control requests go to that renderer, since the
+    ConnectionManager and the SCPD of the AVTransport are queried too.
+    """
+    global quirks, sink_mime_types
+    description = get_device_description(location)
+    fields = dict(description.root_device) if description else {}
+    fields['server'] = next((server for server_location, server in renderer_registry.lookup() if server_location == location), '')
+    quirks, names = renderer_quirks(fields, load_quirks_profiles(config.quirks_file))
+
+    service = get_service_description("AVTransport")
+    if quirks['set_next'] and service and service.introspected and 'SetNextAVTransportURI' not in service.actions:
+        print("The renderer has no SetNextAVTransportURI action, gapless playback is off.")
+        quirks['set_next'] = False
+    protocol_info = invoke("ConnectionManager", "GetProtocolInfo")
+    sink_mime_types = parse_protocol_info(protocol_info.get('Sink')) if protocol_info else None
+
+    print(f"Renderer profile: {', '.join(names) or 'default'} {quirks}")
+
+
+def renderer_accepts(mime):
+    """
+    Returns False if the quirks list the MIME types of the renderer and mime is not one of them.
+
+    A type missing from the GetProtocolInfo Sink only gives a warning: many
+    renderers play more than they list there.
+    """
+    if not mime:
+        return True
+    mime = mime.lower()
+    if quirks['mime_types'] is not None:
+        return mime in (mime_type.lower() for mime_type in quirks['mime_types'])
+    if sink_mime_types and mime not in sink_mime_types:
+        print(f"Warning: the renderer does not list {mime} among the formats it plays.")
+    return True
+
+
+# --- Renderer health ---
+class RendererLost(Exception):
+    """Raised by get_transport_info_loop() when the renderer stopped answering."""
+
+    def __init__(self, position):
+        super().__init__("renderer not answering")
+        self.position = position
+
+
+class RendererHealth:
+    """
+    Health of the selected renderer: healthy, suspect or lost.
+
+    A failed request makes the renderer suspect and is retried with an
+    exponential backoff; after health_max_failures failures in a row, or
+    at the first failure after an ssdp:byebye, it is lost. The SSDP
+    listener reports the renderer announcing itself again, possibly under
+    a new LOCATION (e.g. a new IP address from DHCP).
+    """
+
+    HEALTHY = 'healthy'
+    SUSPECT = 'suspect'
+    LOST = 'lost'
+
+    def __init__(self):
+        self.state = self.HEALTHY
+        self.udn = None
+        self.location = None
+        self.failures = 0
+        self.said_byebye = False
+        self.lost_since = None
+        self.new_location = None
+        self.lock = threading.Lock()
+        # Set when the renderer announces itself, to cut a wait short
+        self.changed = threading.Event()
+
+    def watch(self, udn, location):
+        """Starts following the renderer with this UDN, now at location."""
+        with self.lock:
+            self.udn = udn
+            self.location = location
+            self.new_location = None
+            self.state = self.HEALTHY
+            self.failures = 0
+            self.said_byebye = False
+            self.lost_since = None
+
+    def success(self):
+        with self.lock:
+            if self.state != self.HEALTHY:
+                print("Renderer is answering again.")
+            self.state = self.HEALTHY
+            self.failures = 0
+            self.said_byebye = False
+            self.lost_since = None
+
+    def failure(self):
+        """
+        Records a failed request.
+
+        Returns:
+            The seconds to wait before trying again, or None if the renderer is lost.
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == self.LOST or self.said_byebye or self.new_location or self.failures >= config.health_max_failures:
+                if self.state != self.LOST:
+                    self.state = self.LOST
+                    self.lost_since = time.time()
+                return None
+            self.state = self.SUSPECT
+            return min(config.health_max_backoff, config.health_backoff * 2 ** (self.failures - 1))
+
+    def seen(self, udn, location):
+        """Called by the SSDP listener for every alive message of a renderer."""
+        if not udn or udn != self.udn:
+            return
+        with self.lock:
+            self.said_byebye = False
+            if location != self.location and location != self.new_location:
+                print(f"Renderer moved to {location}")
+                self.new_location = location
+        self.changed.set()
+
+    def left(self, udn):
+        """Called by the SSDP listener for every ssdp:byebye."""
+        if not udn or udn != self.udn:
+            return
+        with self.lock:
+            self.said_byebye = True
+        self.changed.set()
+
+    def lost_for(self):
+        """Returns the seconds since the renderer was lost, 0 if it is not."""
+        with self.lock:
+            return time.time() - self.lost_since if self.lost_since else 0
+
+
+renderer_health = RendererHealth()
+
+
+def switch_renderer(location):
+    """
+    Sends the control requests to the renderer at location: the same
+    renderer under a new address, or another one taking over.
+
+    Returns:
+        True if the renderer has an AVTransport service.
+    """
+    global RENDERER_LOCATION, CONTROL_URL, ip_address, FILE_PATH_ICON
+    description = get_device_description(location)
+    service = description.find_service("AVTransport") if description else None
+    if not service or not service['control_url']:
+        return False
+    RENDERER_LOCATION = location
+    CONTROL_URL = service['control_url']
+    service_cache.clear()
+    ip_address = get_local_ip(urlparse(CONTROL_URL).hostname) or ip_address
+    FILE_PATH_ICON = "http://" + url_host(ip_address) + ":" + str(config.SERVER_PORT) + "/" + ICON_ID
+    # Their URLs may point to our previous address
+    prepared_tracks.clear()
+    renderer_health.watch(description.root_device['udn'], location)
+    print(f"Renderer: {description.friendly_name} at {location}, serving on {ip_address}")
+    volume_controller.reset()
+    subscribe_events("RenderingControl", volume_controller.on_event)
+    apply_renderer_quirks(location)
+    return True
+
+
+def failover_renderer():
+    """
+    Switches to the first renderer of failover_renderers on the network.
+
+    Returns:
+        True if one took over.
+    """
+    for location, server in renderer_registry.lookup():
+        description = get_device_description(location)
+        if description is None or description.root_device['udn'] == renderer_health.udn:
+            continue
+        names = {(description.friendly_name or '').lower(), (description.root_device['udn'] or '').lower()}
+        if names & set(config.failover_renderers) and switch_renderer(location):
+            print(f"Failed over to {description.friendly_name}")
+            return True
+    return False
+
+
+def wait_for_renderer():
+    """
+    Blocks while the renderer is lost, until it answers again, comes back
+    under a new address or, after failover_after seconds, another renderer
+    of failover_renderers takes over.
+    """
+    print("Renderer lost, queue paused.")
+    delay = config.health_backoff
+    while True:
+        new_location = renderer_health.new_location
+        if new_location and switch_renderer(new_location):
+            return
+        if invoke("AVTransport", "GetTransportInfo") is not None:
+            renderer_health.success()
+            return
+        if config.failover_renderers and renderer_health.lost_for() >= config.failover_after and failover_renderer():
+            return
+        # Search again: the answer of the renderer tells its current LOCATION
+        discover_devices()
+        renderer_health.changed.wait(delay)
+        renderer_health.changed.clear()
+        delay = min(config.health_max_backoff, delay * 2)
+
+
+# --- GetTransportInfo Loop ---
+def get_transport_info_loop(current_file=None, on_near_end=None):
+    """
+    Polls the transport state until the track ends.
+
+    Returns:
+        (skipped, started_uri): skipped is True if the user skipped the track,
+        started_uri is the URI the renderer went on to by itself, when
+        on_near_end queued it with SetNextAVTransportURI.
+
+    Failed polls are retried with a backoff; RendererLost is raised with
+    the last known position once renderer_health considers the renderer lost.
+
+    The polls are scheduled by a PositionTracker around the predicted end of
+    the track. While current_file is playing its position is checkpointed every
+    checkpoint_interval seconds so playback can be resumed after a restart, and
+    on_near_end is called once when prepare_ahead seconds are left. It returns
+    the URI it queued on the renderer, or None.
+    """
+    proc_running = True
+    skipped = False
+    last_checkpoint = time.time()
+    tracker = PositionTracker(config.poll_interval, config.min_poll_interval, config.position_sync_interval)
+    near_end_called = False
+    next_uri = None  # Queued with SetNextAVTransportURI by on_near_end
+    started_uri = None
+    last_position = None  # Where to resume if the renderer is lost
+    wake_event = threading.Event()  # Cuts the wait between polls short on key presses
+    paused = False
+    ctrl_held = False
+    lock = threading.Lock()
+    stop_event = threading.Event()  # Add an event to signal the listener to stop
+    
+    def on_press(key):
+        nonlocal paused, proc_running, ctrl_held, skipped
+        
+        # Check if the stop event is set
+        if stop_event.is_set():
+            return False  # This will stop the listener
+        
+        # Check if Control key is pressed
+        if hasattr(keyboard, 'Key') and isinstance(key, keyboard.Key) and key in (keyboard.Key.ctrl_l, keyboard.Key.ctrl_r, keyboard.Key.ctrl):
+            ctrl_held = True
+            return
+        
+        # Handle Ctrl+key combinations when ctrl is held
+        if ctrl_held:
+            try:
+                if hasattr(key, 'char') and key.char:
+                    if key.char == 'p':
+                        with lock:
+                            paused = True
+                            pause_response = invoke("AVTransport", "Pause")
+                            if pause_response is not None:
+                                print(f"pause_response: {pause_response}")
+                            print("Loop paused")
+                        wake_event.set()
+                    elif key.char == 'r':
+                        with lock:
+                            paused = False
+                            Play_info_response = invoke("AVTransport", "Play", Speed="1")
+                            if Play_info_response is not None:
+                                print(f"Play_info_response: {Play_info_response}")
+                            print("Loop resumed")
+                        wake_event.set()
+                    elif key.char == 'n':
+                        with lock:
+                            print("Ctrl+n pressed. Exiting loop and go to the next song.")
+                            proc_running = False
+                            skipped = True
+                        wake_event.set()
+                    elif key.char == 'u':
+                        volume_controller.change_volume(config.volume_step)
+                    elif key.char == 'd':
+                        volume_controller.change_volume(-config.volume_step)
+                    elif key.char == 'm':
+                        volume_controller.toggle_mute()
+            except (AttributeError, TypeError):
+                pass
+
+    def on_release(key):
+        nonlocal ctrl_held
+        # Check if the stop event is set
+        if stop_event.is_set():
+            return False  # This will stop the listener
+            
+        if hasattr(keyboard, 'Key') and isinstance(key, keyboard.Key) and key in (keyboard.Key.ctrl_l, keyboard.Key.ctrl_r, keyboard.Key.ctrl):
+            ctrl_held = False
+
+    # Start keyboard listener in a separate thread
+    listener = keyboard.Listener(on_press=on_press, on_release=on_release)
+    listener.daemon = True
+    listener.start()
+
+    try:
+        while proc_running:
+            with lock:
+                if not proc_running:
+                    break
+                
+            if paused:
+                tracker.set_playing(False, time.time())
+                time.sleep(0.1)
+                continue
+
+            now = time.time()
+            remaining = tracker.remaining(now)
+            # After a gapless transition the transport stays PLAYING, only TrackURI changes:
+            # past the predicted end every poll checks it
+            if tracker.needs_sync(now) or (next_uri and remaining is not None and remaining <= 0):
+                position = get_position_info()
+                if position and next_uri and position.get('TrackURI') == next_uri:
+                    print("The renderer went on to the next track.")
+                    started_uri = next_uri
+                    break
+                if position:
+                    tracker.update(position, now)
+                
+            transport_info = invoke("AVTransport", "GetTransportInfo")
+            
+            if transport_info is None:
+                delay = renderer_health.failure()
+                if delay is None:
+                    raise RendererLost(last_position)
+                print(f"GetTransportInfo request failed, retrying in {delay:g}s.")
+                wake_event.wait(delay)
+                wake_event.clear()
+                continue
+            renderer_health.success()
+
+            transport_state = transport_info.get('CurrentTransportState')
+            if transport_state is None:
+                print(f"Error: no CurrentTransportState in {transport_info}")
+                break
+            print(f"Transport status: {transport_state}")
+
+            if transport_state == "STOPPED":
+                print("Player is STOPPED....")
+                proc_running = False
+
+            transport_status = transport_info.get('CurrentTransportStatus', "N/A")
+            print(f"Specific state: {transport_status}")
+
+            now = time.time()
+            tracker.set_playing(transport_state == "PLAYING", now)
+            position = tracker.position(now)
+            if position is not None:
+                last_position = position
+            if current_file and proc_running and transport_state == "PLAYING" and position is not None and now - last_checkpoint >= config.checkpoint_interval:
+                save_resume_state(current_file, format_time(position))
+                last_checkpoint = now
+
+            remaining = tracker.remaining(now)
+            if on_near_end and proc_running and not near_end_called and remaining is not None and remaining <= config.prepare_ahead:
+                near_end_called = True
+                next_uri = on_near_end()
+
+            if not proc_running:
+                break
+            wake_event.wait(tracker.next_poll_delay(time.time(), config.prepare_ahead))
+            wake_event.clear()
+            
+    finally:
+        # Set the stop event to signal the listener to stop
+        stop_event.set()
+        
+        # Create a timeout for the join operation
+        join_timeout = 0.5  # 500ms should be enough for the listener to stop
+        join_start = time.time()
+        
+        while listener.is_alive() and (time.time() - join_start) < join_timeout:
+            time.sleep(0.1)  # Short sleep to prevent CPU spinning
+        
+        if listener.is_alive():
+            print("Warning: Keyboard listener thread didn't terminate cleanly")
+
+    return skipped, started_uri
+
+
+
+
+def extract_number_from_filename(filename):
+    """
+    Extracts the number from a filename, handling different variations.
+
+    Returns None for filenames that do not start with a number.
+    """
+    match = re.match(r"^(\d+)", filename)  # Handles numbers without leading zeros
+    if match:
+        return int(match.group(1))  # Directly converts to integer
+    return None  # Handles the case of "file" without a number
+
+
+def is_media_file(filename):
+    """Returns True if filename has a video extension."""
+    return filename.endswith('.mkv') or filename.endswith('.webm') or filename.endswith('.mp4')
+
+
+def match_file(filename, threshold, include_unnumbered=True):
+    """
+    Checks a single file against the filter of filter_files_by_number().
+
+    Returns:
+        The number used to sort the file (0 for files without a number), or
+        None if the file is not played.
+    """
+    if not is_media_file(filename):
+        return None
+    file_number = extract_number_from_filename(filename)
+    if file_number is None:
+        if not include_unnumbered:
+            print(f"File without number ignored: {filename}")
+            return None
+        # Counts as number 0, so a threshold above 0 still leaves it out
+        file_number = 0
+    return file_number if file_number >= threshold else None
+
+
+def filter_files_by_number(directory, threshold, order_files, include_unnumbered=True):
+    """Filters files in a directory based on a number in their name.
+
+    Args:
+        directory: The path to the directory.
+        threshold: The minimum number that the file number must be.
+        order_files: A boolean value indicating whether to order the files.
+        include_unnumbered: Whether files without a leading number are kept.
+            They are not subject to the threshold and sort first.
+
+    Returns:
+        A list of filenames that meet the criteria, sorted if order_files is
+        True. Shuffling is left to PlayQueue.
+    """
+
+    # Check that the directory exists
+    if not os.path.isdir(directory):
+        print(f"The directory {directory} does not exist.")
+        return []  # Return an empty list if the directory does not exist
+
+    # List to store the files that meet the criteria
+    filtered_files = []
+
+    # Iterate through all the files in the directory
+    for filename in os.listdir(directory):
+        file_number = match_file(filename, threshold, include_unnumbered)
+        # Add the file to the list if the number is greater than the threshold
+        if file_number is not None:
+            filtered_files.append((file_number, filename))
+
+    # Sort the files based on the order_files variable
+    if order_files:
+        sorted_files = sorted(filtered_files)
+    else:
+        sorted_files = filtered_files
+
+    # Extract only the filenames from the list of tuples
+    sorted_files_names = [filename for _, filename in sorted_files]
+
+    return sorted_files_names  # Return the list of filenames
+
+
+# --- Playlists ---
+PLAYLIST_EXTENSIONS = ('.m3u', '.m3u8', '.pls', '.xspf')
+# Files handed to the main loop at a time while a playlist is read
+PLAYLIST_BATCH_SIZE = 500
+XSPF_NS = '{http://xspf.org/ns/0/}'
+
+
+def iter_m3u(f):
+    """Yields the entries of an M3U/M3U8 playlist: the lines that are not blank, #EXT directives or comments."""
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def iter_pls(f):
+    """Yields the FileN entries of a PLS playlist, in file order."""
+    for line in f:
+        key, sep, value = line.strip().partition('=')
+        if sep and key.lower().startswith('file') and key[4:].isdigit() and value.strip():
+            yield value.strip()
+
+
+def iter_xspf(f):
+    """Yields the track locations of an XSPF playlist, parsing it incrementally."""
+    for event, element in ET.iterparse(f, events=('end',)):
+        if element.tag == XSPF_NS + 'track':
+            location = element.findtext(XSPF_NS + 'location')
+            if location and location.strip():
+                yield location.strip()
+            element.clear()
+
+
+def resolve_playlist_entry(entry, base_dir):
+    """
+    Returns the local path of a playlist entry, or None for a remote URL.
+
+    file:// URLs are decoded and relative paths resolved against the folder
+    of the playlist.
+    """
+    if entry.lower().startswith('file:'):
+        entry = unquote(urlparse(entry).path)
+    elif re.match(r"^[a-z][a-z0-9+.-]*://", entry, re.IGNORECASE):
+        return None
+    if os.sep == '/':
+        # Playlists written on Windows
+        entry = entry.replace('\\', '/')
+    return os.path.normpath(os.path.join(base_dir, os.path.expanduser(entry)))
+
+
+def queue_name(path):
+    """Returns the name a file is queued under: relative to directory_path when inside it, else absolute."""
+    root = os.path.abspath(config.directory_path)
+    path = os.path.abspath(path)
+    if path.startswith(root + os.sep):
+        return os.path.relpath(path, root)
+    return path
+
+
+def iter_playlist(playlist_path):
+    """
+    Yields the queue names of the files of an M3U, M3U8, PLS or XSPF playlist.
+
+    The playlist is read as the names are consumed, so a long one does not
+    have to be read entirely before playback starts. Remote URLs, missing
+    and unsupported files are reported and skipped.
+    """
+    extension = os.path.splitext(playlist_path)[1].lower()
+    base_dir = os.path.dirname(os.path.abspath(playlist_path))
+    skipped = 0
+    try:
+        if extension == '.xspf':
+            f = open(playlist_path, 'rb')
+            entries = iter_xspf(f)
+        else:
+            # .m3u files are often not UTF-8, a bad byte must not stop the whole playlist
+            f = open(playlist_path, encoding='utf-8-sig', errors='replace')
+            entries = iter_pls(f) if extension == '.pls' else iter_m3u(f)
+        with f:
+            for entry in entries:
+                path = resolve_playlist_entry(entry, base_dir)
+                if path is None:
+                    print(f"Playlist entry skipped, not a local file: {entry}")
+                elif not is_media_file(path):
+                    print(f"Playlist entry skipped, unsupported file: {entry}")
+                elif not os.path.isfile(path):
+                    print(f"Playlist entry skipped, file missing: {entry}")
+                else:
+                    yield queue_name(path)
+                    continue
+                skipped += 1
+    except (OSError, ET.ParseError) as e:
+        print(f"Error reading playlist {playlist_path}: {e}")
+    if skipped:
+        print(f"{skipped} entries of {playlist_path} skipped.")
+
+
+playlist_generation = 0
+# Set while a playlist is being read, so the main loop waits for it instead of ending
+playlist_loading = threading.Event()
+
+
+def load_playlist(generation, playlist_path, start_after=None):
+    """
+    Reads a playlist and hands its files to the main loop in batches.
+
+    The first file is handed over alone so playback can start at once.
+    With start_after, the files up to it are skipped (unless it is not in
+    the playlist). A newer load_playlist() call makes this one stop.
+    """
+    entries = iter_playlist(playlist_path)
+    if start_after:
+        # Consumes the entries up to start_after
+        if start_after not in entries:
+            print(f"{start_after} not found in {playlist_path}, starting from the top.")
+            entries = iter_playlist(playlist_path)
+    batch = []
+    batch_size = 1
+    count = 0
+    for filename in entries:
+        if generation != playlist_generation:
+            return
+        index_file(filename)
+        batch.append(filename)
+        count += 1
+        if len(batch) >= batch_size:
+            library_changes.put(('playlist', (generation, batch)))
+            batch = []
+            batch_size = PLAYLIST_BATCH_SIZE
+    library_changes.put(('playlist', (generation, batch)))
+    library_changes.put(('playlist_done', (generation, count)))
+
+
+def start_playlist_loader(start_after=None):
+    """Starts reading the playlist option in the background, replacing any playlist still being read."""
+    global playlist_generation
+    playlist_generation += 1
+    playlist_loading.set()
+    loader = threading.Thread(target=load_playlist, args=(playlist_generation, config.playlist, start_after))
+    loader.daemon = True
+    loader.start()
+
+
+# --- Play history and queue engine ---
+class PlayHistory:
+    """
+    Persistent record of played tracks, used to avoid repeats across runs.
+
+    The history file holds one line per play: play count, last played
+    timestamp and filename, separated by tabs. A play appends a line, the
+    last line of a track wins and the file is compacted when it is loaded.
+    """
+
+    def __init__(self, history_file, history_size):
+        self.history_file = history_file
+        self.history_size = history_size
+        self.play_counts = {}
+        self.last_played = {}
+        self.load()
+
+    def load(self):
+        """Loads the history file, ignoring malformed lines, and compacts it."""
+        if not self.history_file or not os.path.exists(self.history_file):
+            return
+        line_count = 0
+        try:
+            with open(self.history_file, encoding='utf-8') as f:
+                for line in f:
+                    line_count += 1
+                    parts = line.rstrip('\n').split('\t', 2)
+                    if len(parts) != 3:
+                        continue
+                    try:
+                        self.play_counts[parts[2]] = int(parts[0])
+                        self.last_played[parts[2]] = float(parts[1])
+                    except ValueError:
+                        continue
+        except OSError as e:
+            print(f"Error reading play history {self.history_file}: {e}")
+            return
+        if line_count > len(self.play_counts):
+            self.save()
+
+    def save(self):
+        """Writes the history file atomically."""
+        if not self.history_file:
+            return
+        temp_file = self.history_file + ".tmp"
+        try:
+            with open(temp_file, "w", encoding='utf-8') as f:
+                for filename, count in self.play_counts.items():
+                    f.write(f"{count}\t{self.last_played.get(filename, 0)}\t{filename}\n")
+            os.replace(temp_file, self.history_file)
+        except OSError as e:
+            print(f"Error writing play history {self.history_file}: {e}")
+
+    def record(self, filename):
+        """Records a play of filename and appends it to the history file."""
+        self.play_counts[filename] = self.play_counts.get(filename, 0) + 1
+        self.last_played[filename] = time.time()
+        if not self.history_file:
+            return
+        try:
+            with open(self.history_file, "a", encoding='utf-8') as f:
+                f.write(f"{self.play_counts[filename]}\t{self.last_played[filename]}\t{filename}\n")
+        except OSError as e:
+            print(f"Error writing play history {self.history_file}: {e}")
+
+    def play_count(self, filename):
+        return self.play_counts.get(filename, 0)
+
+    def recent(self):
+        """Returns the set of the history_size most recently played filenames."""
+        if self.history_size <= 0:
+            return set()
+        most_recent = sorted(self.last_played, key=self.last_played.get, reverse=True)
+        return set(most_recent[:self.history_size])
+
+
+def artist_from_filename(filename):
+    """
+    Guesses the artist from a filename like "012 - Artist - Title.mp3".
+
+    Returns the filename itself when no artist can be found, so that unknown
+    tracks are spread as if each had its own artist.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    name = re.sub(r"^[\d\s._-]+", "", name)
+    if " - " in name:
+        return name.split(" - ", 1)[0].strip().lower()
+    return filename
+
+
+def weighted_shuffle(files, history):
+    """Shuffles files, favouring tracks with fewer plays in the history."""
+    keyed = [(random.random() ** (1 + history.play_count(filename)), filename) for filename in files]
+    keyed.sort(reverse=True)
+    return [filename for _, filename in keyed]
+
+
+def artist_spread_shuffle(files):
+    """Shuffles files, spreading the tracks of each artist evenly over the queue."""
+    groups = {}
+    for filename in files:
+        groups.setdefault(artist_from_filename(filename), []).append(filename)
+
+    keyed = []
+    for tracks in groups.values():
+        random.shuffle(tracks)
+        count = len(tracks)
+        offset = random.random() / count
+        for i, filename in enumerate(tracks):
+            jitter = random.uniform(-0.1, 0.1) / count
+            keyed.append((offset + i / count + jitter, filename))
+    keyed.sort()
+    return [filename for _, filename in keyed]
+
+
+class PlayQueue:
+    """
+    Playback queue with shuffle and repeat modes.
+
+    Enqueue, skip and remove are O(1): removed entries are only dropped from
+    the set of live entries and discarded lazily when they reach the head.
+    The files played on repeat are the keys of a dict, which keeps their
+    order and lets a deleted file be forgotten in O(1) too.
+    """
+
+    def __init__(self, files, order_files, shuffle_mode, repeat_mode, history):
+        self.order_files = order_files
+        self.shuffle_mode = shuffle_mode
+        self.repeat_mode = repeat_mode
+        self.history = history
+        self.all_files = {}
+        self.queue = deque()
+        self.queued = set()
+        self.current = None
+        for filename in self.build_order(files):
+            self.enqueue(filename)
+
+    def build_order(self, files):
+        """Returns files in playback order, moving recently played tracks to the end when shuffling."""
+        if self.order_files:
+            return list(files)
+
+        recent = self.history.recent()
+        fresh = [filename for filename in files if filename not in recent]
+        stale = sorted((filename for filename in files if filename in recent),
+                       key=lambda filename: self.history.last_played.get(filename, 0))
+
+        if self.shuffle_mode == 'weighted':
+            fresh = weighted_shuffle(fresh, self.history)
+        elif self.shuffle_mode == 'artist_spread':
+            fresh = artist_spread_shuffle(fresh)
+        else:
+            random.shuffle(fresh)
+        return fresh + stale
+
+    def enqueue(self, filename):
+        """Appends filename to the queue unless it is already queued. Returns True if added."""
+        if filename in self.queued:
+            return False
+        self.all_files.setdefault(filename)
+        self.queue.append(filename)
+        self.queued.add(filename)
+        return True
+
+    def extend(self, files):
+        """Appends files to the queue, shuffled among themselves unless order_files is set."""
+        for filename in self.build_order(files):
+            self.enqueue(filename)
+
+    def remove(self, filename):
+        """Removes filename from the queue."""
+        self.queued.discard(filename)
+
+    def add_file(self, filename, append=True):
+        """
+        Adds a new file to the files played on repeat, and to the end of the
+        queue if append is True. Returns True if it was queued.
+        """
+        if append:
+            return self.enqueue(filename)
+        self.all_files.setdefault(filename)
+        return False
+
+    def discard_file(self, filename):
+        """Forgets a deleted file: it is removed from the queue and not repeated. Returns True if it was known."""
+        self.queued.discard(filename)
+        if filename not in self.all_files:
+            return False
+        del self.all_files[filename]
+        return True
+
+    def resume_from(self, filename):
+        """
+        Makes filename the next track to play. Returns False if it is not queued.
+
+        In order mode the tracks before it are dropped, when shuffling the play
+        history already moves the tracks played before the restart to the end.
+        """
+        if filename not in self.queued:
+            return False
+        if self.order_files:
+            while self.queue and self.queue[0] != filename:
+                self.queued.discard(self.queue.popleft())
+        else:
+            # The later copy is skipped lazily once this one has been played
+            self.queue.appendleft(filename)
+        return True
+
+    def peek(self):
+        """Returns the filename that next_track() will return, without advancing the queue."""
+        if self.repeat_mode == 'one' and self.current is not None:
+            return self.current
+        while self.queue and self.queue[0] not in self.queued:
+            self.queue.popleft()
+        return self.queue[0] if self.queue else None
+
+    def next_track(self, skipped=False):
+        """
+        Returns the next filename to play, or None when the queue is exhausted.
+
+        Args:
+            skipped: True if the current track was skipped by the user, which
+                moves on even in repeat one mode.
+        """
+        if self.repeat_mode == 'one' and self.current is not None and not skipped:
+            return self.current
+
+        while True:
+            while self.queue:
+                filename = self.queue.popleft()
+                if filename in self.queued:
+                    self.queued.discard(filename)
+                    self.current = filename
+                    return filename
+            if self.repeat_mode != 'all' or not self.all_files:
+                self.current = None
+                return None
+            for filename in self.build_order(self.all_files):
+                self.queue.append(filename)
+                self.queued.add(filename)
+
+    def reconfigure(self, files, order_files, shuffle_mode, repeat_mode):
+        """
+        Replaces the files and modes of the queue. The current track stays
+        current; in order mode the queue continues after it.
+        """
+        self.order_files = order_files
+        self.shuffle_mode = shuffle_mode
+        self.repeat_mode = repeat_mode
+        order = self.build_order(files)
+        self.all_files = dict.fromkeys(order)
+        if self.order_files and self.current in self.all_files:
+            order = order[order.index(self.current) + 1:]
+        self.queue = deque(filename for filename in order if filename != self.current)
+        self.queued = set(self.queue)
+
+    def __len__(self):
+        return len(self.queued)
+
+
+# --- Watch folder ---
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def open_inotify(directory, mask):
+    """
+    Returns a non-blocking inotify file descriptor watching directory.
+
+    Raises:
+        OSError: If inotify is not available (not Linux, or no watches left).
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError("inotify is not available on this system")
+    fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+        error = ctypes.get_errno()
+        os.close(fd)
+        raise OSError(error, f"inotify_add_watch failed for {directory}")
+    return fd
+
+
+def read_inotify_events(fd):
+    """Returns the pending (mask, filename) events of an inotify file descriptor."""
+    try:
+        data = os.read(fd, 64 * 1024)
+    except BlockingIOError:
+        return []
+    events = []
+    offset = 0
+    while offset + INOTIFY_EVENT.size <= len(data):
+        _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+        offset += INOTIFY_EVENT.size
+        events.append((mask, os.fsdecode(data[offset:offset + length].rstrip(b'\0'))))
+        offset += length
+    return events
+
+
+class FolderWatcher:
+    """
+    Reports files added to and removed from a directory, through inotify on
+    Linux and by listing the directory every watch_poll_interval seconds
+    elsewhere.
+
+    A new file is only reported once its size and modification time have not
+    changed for watch_settle_time seconds, so a file that is still being copied
+    is never queued half written.
+    """
+
+    def __init__(self, directory, on_added, on_removed):
+        self.directory = directory
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.running = False
+        # Files listed or reported so far
+        self.known = set()
+        # Files being written: filename -> (size, mtime, time of the last change)
+        self.pending = {}
+
+    def start(self):
+        self.running = True
+        try:
+            self.known = set(os.listdir(self.directory))
+        except OSError as e:
+            print(f"Error listing {self.directory}: {e}")
+        worker = threading.Thread(target=self.run)
+        worker.daemon = True
+        worker.start()
+
+    def stop(self):
+        self.running = False
+
+    def touched(self, filename):
+        """Records a change to a file, restarting its settle time."""
+        try:
+            stat_result = os.stat(os.path.join(self.directory, filename))
+        except OSError:
+            return
+        self.pending[filename] = (stat_result.st_size, stat_result.st_mtime, time.monotonic())
+
+    def removed(self, filename):
+        self.pending.pop(filename, None)
+        if filename in self.known:
+            self.known.discard(filename)
+            self.on_removed(filename)
+
+    def rescan(self):
+        """Compares a new listing of the directory with the known files."""
+        try:
+            current = set(os.listdir(self.directory))
+        except OSError as e:
+            print(f"Error listing {self.directory}: {e}")
+            return
+        for filename in current - self.known:
+            if filename not in self.pending:
+                self.touched(filename)
+        for filename in self.known - current:
+            self.removed(filename)
+
+    def check_pending(self):
+        """Reports the pending files that have stopped changing."""
+        now = time.monotonic()
+        for filename, (size, mtime, changed) in list(self.pending.items()):
+            try:
+                stat_result = os.stat(os.path.join(self.directory, filename))
+            except OSError:
+                del self.pending[filename]
+                continue
+            if (stat_result.st_size, stat_result.st_mtime) != (size, mtime):
+                self.pending[filename] = (stat_result.st_size, stat_result.st_mtime, now)
+            elif now - changed >= config.watch_settle_time:
+                del self.pending[filename]
+                self.known.add(filename)
+                self.on_added(filename)
+
+    def run(self):
+        try:
+            fd = open_inotify(self.directory, IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+        except (OSError, AttributeError) as e:
+            print(f"inotify not available ({e}), checking {self.directory} every {config.watch_poll_interval} seconds.")
+            fd = None
+        print(f"Watching {self.directory} for new files...")
+
+        selector = None
+        if fd is not None:
+            selector = selectors.DefaultSelector()
+            selector.register(fd, selectors.EVENT_READ)
+        try:
+            while self.running:
+                if selector is None:
+                    time.sleep(min(config.watch_poll_interval, config.watch_settle_time) if self.pending else config.watch_poll_interval)
+                    self.rescan()
+                else:
+                    # Wake up regularly to check pending files and stop()
+                    if selector.select(1):
+                        for mask, filename in read_inotify_events(fd):
+                            if mask & IN_Q_OVERFLOW:
+                                self.rescan()
+                            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                                self.removed(filename)
+                            elif filename not in self.known:
+                                self.touched(filename)
+                self.check_pending()
+        finally:
+            if selector is not None:
+                selector.close()
+                os.close(fd)
+
+
+# Added and removed files, applied to the queue by the main loop, which
+# also waits on it for configuration reloads when the queue is empty
+library_changes = queue.Queue()
+folder_watcher = None
+
+
+def index_file(filename):
+    """Starts probing a file that is about to be queued."""
+    if video_metadata:
+        video_metadata.submit(os.path.join(config.directory_path, filename))
+
+
+def on_library_file_added(filename):
+    """Indexes a new file right away and hands it to the main loop for queueing."""
+    if os.path.splitext(filename)[1].lower() in SUBTITLE_EXTENSIONS:
+        if config.subtitles:
+            index_subtitle(subtitle_index, filename)
+        return
+    if match_file(filename, config.threshold, config.include_unnumbered) is None:
+        return
+    index_file(filename)
+    library_changes.put(('added', filename))
+
+
+def on_library_file_removed(filename):
+    library_changes.put(('removed', filename))
+
+
+def apply_library_change(change):
+    action, value = change
+    if action == 'added':
+        if play_queue.add_file(value, append=config.watch_append):
+            print(f"Queued new file: {value}")
+    elif action == 'removed':
+        if play_queue.discard_file(value):
+            prepared_tracks.pop(value, None)
+            print(f"Removed from the queue: {value}")
+    elif action == 'config':
+        # Only wakes the main loop up, which then rebuilds the queue if requested
+        pass
+    elif value[0] == playlist_generation:
+        if action == 'playlist':
+            play_queue.extend(value[1])
+        else:
+            playlist_loading.clear()
+            print(f"Playlist {config.playlist}: {value[1]} files")
+
+
+def apply_library_changes():
+    """Applies the files added and removed since the last call to the queue."""
+    while True:
+        try:
+            change = library_changes.get_nowait()
+        except queue.Empty:
+            return
+        apply_library_change(change)
+
+
+def restart_folder_watcher():
+    """(Re)starts watching directory_path if watch_folder is enabled."""
+    global folder_watcher
+    if folder_watcher:
+        folder_watcher.stop()
+        folder_watcher = None
+    if config.watch_folder:
+        folder_watcher = FolderWatcher(config.directory_path, on_library_file_added, on_library_file_removed)
+        folder_watcher.start()
+
+
+# --- Video metadata ---
+MP4_CONTAINERS = ('.mp4', '.m4v', '.mov')
+MATROSKA_CONTAINERS = ('.mkv', '.webm')
+VIDEO_MIME_TYPES = {
+    '.mp4': 'video/mp4',
+    '.m4v': 'video/mp4',
+    '.mov': 'video/quicktime',
+    '.mkv': 'video/x-matroska',
+    '.webm': 'video/webm',
+    '.avi': 'video/x-msvideo',
+    '.ts': 'video/mp2t',
+    '.mpg': 'video/mpeg',
+    '.mpeg': 'video/mpeg',
+}
+# Codec names as reported by the containers, mapped to ffprobe's names
+VIDEO_CODEC_NAMES = {
+    'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc', 'mp4v': 'mpeg4',
+    'mp4a': 'aac', 'ac-3': 'ac3', 'ec-3': 'eac3',
+    'V_MPEG4/ISO/AVC': 'h264', 'V_MPEGH/ISO/HEVC': 'hevc', 'V_VP8': 'vp8', 'V_VP9': 'vp9', 'V_AV1': 'av1',
+    'A_AAC': 'aac', 'A_AC3': 'ac3', 'A_EAC3': 'eac3', 'A_OPUS': 'opus', 'A_VORBIS': 'vorbis', 'A_MPEG/L3': 'mp3',
+    'tx3g': 'mov_text', 'wvtt': 'webvtt',
+    'S_TEXT/UTF8': 'subrip', 'S_TEXT/ASS': 'ass', 'S_TEXT/SSA': 'ssa', 'S_TEXT/WEBVTT': 'webvtt',
+}
+# H.264 profile_idc and AAC audio object types, by ffprobe's names
+H264_PROFILE_NAMES = {66: 'Baseline', 77: 'Main', 88: 'Extended', 100: 'High', 110: 'High 10', 122: 'High 4:2:2', 244: 'High 4:4:4 Predictive'}
+AAC_PROFILE_NAMES = {1: 'Main', 2: 'LC', 4: 'LTP', 5: 'HE-AAC', 29: 'HE-AACv2'}
+DLNA_FLAGS = "DLNA.ORG_OP=01;DLNA.ORG_CI=0;DLNA.ORG_FLAGS=01700000000000000000000000000000"
+
+# Matroska element ids
+EBML_HEADER = 0x1A45DFA3
+EBML_DOCTYPE = 0x4282
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_CLUSTER = 0x1F43B675
+
+
+def new_video_info(container):
+    """Returns an empty probe result for a container."""
+    return {'container': container, 'duration': None, 'width': None, 'height': None,
+            'bitrate': None, 'video_codec': None, 'audio_codec': None, 'subtitle_codec': None,
+            'video_profile': None, 'video_level': None, 'audio_profile': None, 'audio_channels': None}
+
+
+def iter_mp4_boxes(f, start, end):
+    """Yields (type, data_start, data_end) for the ISO BMFF boxes between start and end."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, box_type = struct.unpack('>I4s', header)
+        header_size = 8
+        if size == 1:
+            large_size = f.read(8)
+            if len(large_size) < 8:
+                return
+            size = struct.unpack('>Q', large_size)[0]
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            return
+        yield box_type, offset + header_size, min(offset + size, end)
+        offset += size
+
+
+def find_mp4_box(f, start, end, path):
+    """Returns (data_start, data_end) of the box at path (e.g. [b'mdia', b'hdlr']), or None."""
+    for box_type, data_start, data_end in iter_mp4_boxes(f, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return data_start, data_end
+            return find_mp4_box(f, data_start, data_end, path[1:])
+    return None
+
+
+def read_mp4_descriptor(data, offset):
+    """Returns (tag, payload offset, payload length) of the MPEG-4 descriptor at offset."""
+    tag = data[offset]
+    offset += 1
+    length = 0
+    for _ in range(4):
+        byte = data[offset]
+        offset += 1
+        length = (length << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            break
+    return tag, offset, length
+
+
+def read_aac_object_type(esds):
+    """Returns the audio object type from the payload of an esds box, or None."""
+    tag, offset, _ = read_mp4_descriptor(esds, 4)  # After version and flags
+    if tag != 0x03:  # ES_Descriptor
+        return None
+    flags = esds[offset + 2]
+    offset += 3
+    if flags & 0x80:
+        offset += 2
+    if flags & 0x40:
+        offset += 1 + esds[offset]
+    if flags & 0x20:
+        offset += 2
+    tag, offset, _ = read_mp4_descriptor(esds, offset)
+    if tag != 0x04:  # DecoderConfigDescriptor
+        return None
+    tag, offset, length = read_mp4_descriptor(esds, offset + 13)
+    if tag != 0x05 or not length:  # DecoderSpecificInfo
+        return None
+    return esds[offset] >> 3
+
+
+def probe_mp4_sample_entry(f, stsd, handler, info):
+    """Reads the H.264 profile and level, or the AAC profile and channels, from the first entry of an stsd box."""
+    f.seek(stsd[0] + 8)
+    entry_size, entry_type = struct.unpack('>I4s', f.read(8))
+    entry_start = stsd[0] + 8
+    entry_end = min(entry_start + entry_size, stsd[1])
+    if handler == b'vide' and entry_type in (b'avc1', b'avc3'):
+        # avcC follows the 78 bytes of the visual sample entry
+        avcc = find_mp4_box(f, entry_start + 8 + 78, entry_end, [b'avcC'])
+        if avcc:
+            f.seek(avcc[0])
+            _, profile_idc, constraints, level = f.read(4)
+            info['video_profile'] = 'Constrained Baseline' if profile_idc == 66 and constraints & 0x40 else H264_PROFILE_NAMES.get(profile_idc)
+            info['video_level'] = level
+    elif handler == b'soun' and entry_type == b'mp4a':
+        f.seek(entry_start + 16)
+        version, = struct.unpack('>H', f.read(2))
+        # QuickTime sound sample entries v1 and v2 are 16 and 36 bytes longer
+        if version == 2:
+            children = entry_start + 8 + 28 + 36
+        else:
+            f.seek(entry_start + 24)
+            info['audio_channels'], = struct.unpack('>H', f.read(2))
+            children = entry_start + 8 + 28 + (16 if version == 1 else 0)
+        esds = find_mp4_box(f, children, entry_end, [b'esds'])
+        if esds:
+            f.seek(esds[0])
+            info['audio_profile'] = AAC_PROFILE_NAMES.get(read_aac_object_type(f.read(esds[1] - esds[0])))
+
+
+def probe_mp4(path):
+    """
+    Reads duration, resolution and codecs from the moov box of an MP4/MOV file.
+
+    Only box headers and a few fixed-size fields are read, so the cost does not
+    depend on the size of the file, even when moov is stored at the end.
+    """
+    info = new_video_info('mp4')
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        moov = find_mp4_box(f, 0, file_size, [b'moov'])
+        if moov is None:
+            return None
+        for box_type, start, end in iter_mp4_boxes(f, *moov):
+            if box_type == b'mvhd':
+                f.seek(start)
+                version = f.read(4)[0]
+                if version == 1:
+                    f.seek(start + 20)
+                    timescale, duration = struct.unpack('>IQ', f.read(12))
+                else:
+                    f.seek(start + 12)
+                    timescale, duration = struct.unpack('>II', f.read(8))
+                if timescale:
+                    info['duration'] = duration / timescale
+            elif box_type == b'trak':
+                hdlr = find_mp4_box(f, start, end, [b'mdia', b'hdlr'])
+                stsd = find_mp4_box(f, start, end, [b'mdia', b'minf', b'stbl', b'stsd'])
+                if hdlr is None or stsd is None:
+                    continue
+                f.seek(hdlr[0] + 8)
+                handler = f.read(4)
+                f.seek(stsd[0] + 12)
+                codec = f.read(4).decode('latin-1')
+                codec = VIDEO_CODEC_NAMES.get(codec, codec)
+                if handler == b'vide' and info['video_codec'] is None:
+                    info['video_codec'] = codec
+                    probe_mp4_sample_entry(f, stsd, handler, info)
+                    tkhd = find_mp4_box(f, start, end, [b'tkhd'])
+                    if tkhd:
+                        # Width and height are the last two 16.16 fixed point fields
+                        f.seek(tkhd[1] - 8)
+                        width, height = struct.unpack('>II', f.read(8))
+                        info['width'], info['height'] = width >> 16, height >> 16
+                elif handler == b'soun' and info['audio_codec'] is None:
+                    info['audio_codec'] = codec
+                    probe_mp4_sample_entry(f, stsd, handler, info)
+                elif handler in (b'sbtl', b'text', b'subt') and info['subtitle_codec'] is None:
+                    info['subtitle_codec'] = codec
+    return info
+
+
+def read_ebml_vint(f, keep_marker):
+    """Reads an EBML variable length integer, returning (value, length in bytes)."""
+    first = f.read(1)
+    if not first:
+        raise EOFError
+    value = first[0]
+    length = 1
+    mask = 0x80
+    while not value & mask:
+        mask >>= 1
+        length += 1
+        if length > 8:
+            raise ValueError("Invalid EBML variable length integer")
+    if not keep_marker:
+        value &= mask - 1
+    rest = f.read(length - 1)
+    if len(rest) < length - 1:
+        raise EOFError
+    for byte in rest:
+        value = (value << 8) | byte
+    return value, length
+
+
+def iter_ebml_elements(f, start, end):
+    """Yields (id, data_start, data_end) for the EBML elements between start and end."""
+    offset = start
+    while offset < end:
+        f.seek(offset)
+        try:
+            element_id, id_length = read_ebml_vint(f, True)
+            size, size_length = read_ebml_vint(f, False)
+        except (EOFError, ValueError):
+            return
+        data_start = offset + id_length + size_length
+        if size == (1 << (7 * size_length)) - 1:
+            # Unknown size, the element runs to the end of its parent
+            size = end - data_start
+        yield element_id, data_start, min(data_start + size, end)
+        offset = data_start + size
+
+
+def read_ebml_uint(f, start, end):
+    f.seek(start)
+    return int.from_bytes(f.read(end - start), 'big')
+
+
+def read_ebml_float(f, start, end):
+    f.seek(start)
+    data = f.read(end - start)
+    if len(data) == 4:
+        return struct.unpack('>f', data)[0]
+    if len(data) == 8:
+        return struct.unpack('>d', data)[0]
+    return None
+
+
+def read_ebml_string(f, start, end):
+    f.seek(start)
+    return f.read(end - start).rstrip(b'\0').decode('utf-8', 'replace')
+
+
+def probe_matroska(path):
+    """
+    Reads duration, resolution and codecs from the Info and Tracks elements of
+    a Matroska/WebM file. Clusters are skipped by their size without being read.
+    """
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        elements = iter_ebml_elements(f, 0, file_size)
+        header = next(elements, None)
+        if header is None or header[0] != EBML_HEADER:
+            return None
+        doc_type = 'matroska'
+        for element_id, start, end in iter_ebml_elements(f, header[1], header[2]):
+            if element_id == EBML_DOCTYPE:
+                doc_type = read_ebml_string(f, start, end)
+        info = new_video_info('webm' if doc_type == 'webm' else 'matroska')
+
+        segment = next((e for e in elements if e[0] == MKV_SEGMENT), None)
+        if segment is None:
+            return None
+        timecode_scale = 1000000
+        duration = None
+        found_info = found_tracks = False
+        for element_id, start, end in iter_ebml_elements(f, segment[1], segment[2]):
+            if element_id == MKV_INFO:
+                found_info = True
+                for child_id, child_start, child_end in iter_ebml_elements(f, start, end):
+                    if child_id == MKV_TIMECODE_SCALE:
+                        timecode_scale = read_ebml_uint(f, child_start, child_end)
+                    elif child_id == MKV_DURATION:
+                        duration = read_ebml_float(f, child_start, child_end)
+            elif element_id == MKV_TRACKS:
+                found_tracks = True
+                for entry_id, entry_start, entry_end in iter_ebml_elements(f, start, end):
+                    if entry_id == MKV_TRACK_ENTRY:
+                        read_matroska_track(f, entry_start, entry_end, info)
+            elif element_id == MKV_CLUSTER and found_info and found_tracks:
+                break
+        if duration is not None:
+            info['duration'] = duration * timecode_scale / 1e9
+    return info
+
+
+def read_matroska_track(f, start, end, info):
+    """Fills the codec (and resolution for video) of a TrackEntry into info."""
+    track_type = codec = None
+    width = height = None
+    for element_id, data_start, data_end in iter_ebml_elements(f, start, end):
+        if element_id == MKV_TRACK_TYPE:
+            track_type = read_ebml_uint(f, data_start, data_end)
+        elif element_id == MKV_CODEC_ID:
+            codec = read_ebml_string(f, data_start, data_end)
+        elif element_id == MKV_VIDEO:
+            for child_id, child_start, child_end in iter_ebml_elements(f, data_start, data_end):
+                if child_id == MKV_PIXEL_WIDTH:
+                    width = read_ebml_uint(f, child_start, child_end)
+                elif child_id == MKV_PIXEL_HEIGHT:
+                    height = read_ebml_uint(f, child_start, child_end)
+    if codec is not None:
+        # A_AAC carries the profile as a suffix, e.g. A_AAC/MPEG4/LC
+        codec = VIDEO_CODEC_NAMES.get(codec, VIDEO_CODEC_NAMES.get(codec.split('/')[0], codec))
+    if track_type == 1 and info['video_codec'] is None:
+        info['video_codec'] = codec
+        info['width'], info['height'] = width, height
+    elif track_type == 2 and info['audio_codec'] is None:
+        info['audio_codec'] = codec
+    elif track_type == 17 and info['subtitle_codec'] is None:
+        info['subtitle_codec'] = codec
+
+
+def probe_ffprobe(path):
+    """Reads the container metadata with ffprobe, or returns None if it is not installed."""
+    if shutil.which('ffprobe') is None:
+        return None
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path],
+        capture_output=True, timeout=30, check=True)
+    data = json.loads(result.stdout)
+    format_name = data.get('format', {}).get('format_name', '')
+    if 'webm' in format_name and os.path.splitext(path)[1].lower() == '.webm':
+        container = 'webm'
+    elif 'matroska' in format_name:
+        container = 'matroska'
+    elif 'mp4' in format_name:
+        container = 'mp4'
+    else:
+        container = format_name.split(',')[0] or None
+    info = new_video_info(container)
+    if data.get('format', {}).get('duration'):
+        info['duration'] = float(data['format']['duration'])
+    if data.get('format', {}).get('bit_rate'):
+        info['bitrate'] = int(data['format']['bit_rate'])
+    for stream in data.get('streams', []):
+        if stream.get('codec_type') == 'video' and info['video_codec'] is None:
+            info['video_codec'] = stream.get('codec_name')
+            info['width'], info['height'] = stream.get('width'), stream.get('height')
+            info['video_profile'], info['video_level'] = stream.get('profile'), stream.get('level')
+        elif stream.get('codec_type') == 'audio' and info['audio_codec'] is None:
+            info['audio_codec'] = stream.get('codec_name')
+            info['audio_profile'], info['audio_channels'] = stream.get('profile'), stream.get('channels')
+        elif stream.get('codec_type') == 'subtitle' and info['subtitle_codec'] is None:
+            info['subtitle_codec'] = stream.get('codec_name')
+    return info
+
+
+def probe_video(path):
+    """
+    Probes a video file according to video_probe.
+
+    The MP4 and Matroska headers are parsed directly; ffprobe is used for other
+    containers, or when the built-in parser could not find a duration.
+
+    Returns:
+        A dict with container, duration (seconds), width, height, bitrate (bits
+        per second), video_codec, audio_codec, subtitle_codec, video_profile,
+        video_level, audio_profile and audio_channels, any of which may be None.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    info = None
+    if config.video_probe in ('auto', 'builtin'):
+        try:
+            if extension in MP4_CONTAINERS:
+                info = probe_mp4(path)
+            elif extension in MATROSKA_CONTAINERS:
+                info = probe_matroska(path)
+        except (OSError, struct.error, IndexError) as e:
+            print(f"Error probing {path}: {e}")
+    if config.video_probe in ('auto', 'ffprobe') and (info is None or info['duration'] is None):
+        try:
+            info = probe_ffprobe(path) or info
+        except (OSError, ValueError, subprocess.SubprocessError) as e:
+            print(f"Error running ffprobe on {path}: {e}")
+    if info is None:
+        info = new_video_info(None)
+    if info['bitrate'] is None and info['duration']:
+        try:
+            info['bitrate'] = int(os.path.getsize(path) * 8 / info['duration'])
+        except OSError:
+            pass
+    return info
+
+
+class VideoMetadataCache:
+    """
+    Probes video files in a worker pool and caches the results on disk, keyed by
+    path, size and modification time, so every file is only probed once.
+    Lookups never wait: a file that is not probed yet falls back to its
+    extension. The cache file is written by the workers, never while a file
+    is loaded.
+    """
+
+    # Seconds between writes of the cache file while probes are queued
+    SAVE_INTERVAL = 30
+
+    def __init__(self, cache_file, workers):
+        self.cache_file = cache_file
+        self.entries = {}
+        self.pending = {}
+        self.dirty = False
+        self.last_save = time.time()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # One writer of the cache file at a time
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='video-probe')
+        self.load()
+        atexit.register(self.save)
+
+    def load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading video metadata cache {self.cache_file}: {e}")
+
+    def save(self):
+        """Writes the cache file if any file was probed since the last save."""
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty or not self.cache_file:
+                    return
+                entries = dict(self.entries)
+                self.dirty = False
+                self.last_save = time.time()
+            temp_file = self.cache_file + ".tmp"
+            try:
+                with open(temp_file, "w", encoding='utf-8') as f:
+                    json.dump(entries, f)
+                os.replace(temp_file, self.cache_file)
+            except OSError as e:
+                print(f"Error writing video metadata cache {self.cache_file}: {e}")
+
+    @staticmethod
+    def cache_key(path):
+        stat_result = os.stat(path)
+        return f"{os.path.abspath(path)}|{stat_result.st_size}|{int(stat_result.st_mtime)}"
+
+    def probe(self, path, key):
+        info = probe_video(path)
+        with self.lock:
+            self.entries[key] = info
+            self.pending.pop(key, None)
+            self.dirty = True
+            # Saved once the queued probes are done, and now and then during a long run
+            save_due = not self.pending or time.time() - self.last_save >= self.SAVE_INTERVAL
+        if save_due:
+            self.save()
+        return info
+
+    def submit(self, path):
+        """Queues a file to be probed in the background unless it is already known."""
+        try:
+            key = self.cache_key(path)
+        except OSError:
+            return None
+        with self.lock:
+            if key in self.entries:
+                return None
+            future = self.pending.get(key)
+            if future is None:
+                future = self.pool.submit(self.probe, path, key)
+                self.pending[key] = future
+        return future
+
+    def get(self, path):
+        """
+        Returns the metadata of a file without waiting. A file that is not
+        probed yet gets an empty result and its probe is queued.
+        """
+        try:
+            key = self.cache_key(path)
+        except OSError as e:
+            print(f"Error probing {path}: {e}")
+            return new_video_info(None)
+        with self.lock:
+            info = self.entries.get(key)
+        if info is not None:
+            return info
+        print(f"{path} is not probed yet, using its extension.")
+        self.submit(path)
+        return new_video_info(None)
+
+
+def format_duration(seconds):
+    """Formats seconds as the H:MM:SS.mmm used by the DIDL-Lite res@duration attribute."""
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    return f"{hours}:{minutes:02d}:{milliseconds // 1000:02d}.{milliseconds % 1000:03d}"
+
+
+def dlna_profile(info):
+    """
+    Returns the DLNA.ORG_PN of a file, or None when no standard profile applies.
+
+    A profile is only claimed when every attribute it constrains was probed
+    and is within its limits: strict renderers reject a file whose PN does
+    not match it, while a file without PN is left to the renderer to try.
+    """
+    if info['container'] != 'mp4' or info['video_codec'] != 'h264' or info['audio_codec'] != 'aac':
+        return None
+    # Caches written before these were probed do not have them
+    profile, level = info.get('video_profile'), info.get('video_level')
+    channels = info.get('audio_channels')
+    width, height = info['width'], info['height']
+    if None in (profile, level, channels, width, height) or info.get('audio_profile') != 'LC':
+        return None
+    if profile in ('Constrained Baseline', 'Main') and level <= 30 and width <= 720 and height <= 576 and channels <= 6:
+        return 'AVC_MP4_MP_SD_AAC_MULT5'
+    if profile in ('Constrained Baseline', 'Main', 'High') and level <= 40 and width <= 1920 and height <= 1080 and channels <= 2:
+        return 'AVC_MP4_HP_HD_AAC'
+    return None
+
+
+def video_mime_type(path, info):
+    """Returns the MIME type of a video file, trusting the probed container over the extension."""
+    if info['container'] == 'webm':
+        return 'video/webm'
+    if info['container'] == 'matroska':
+        return 'video/x-matroska'
+    return VIDEO_MIME_TYPES.get(os.path.splitext(path)[1].lower()) or mimetypes.guess_type(path)[0] or 'video/mp4'
+
+
+def video_res_attributes(path, info, mime):
+    """Builds the protocolInfo, size, duration, resolution and bitrate attributes of a <res> element."""
+    profile = dlna_profile(info)
+    protocol_info = f"http-get:*:{mime}:" + (f"DLNA.ORG_PN={profile};" if profile else "") + DLNA_FLAGS
+    attributes = [f'protocolInfo="{escape(protocol_info)}"']
     try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
-        print("Server shutdown...")
-        httpd.server_close()
-    except Exception as e:
-        print(f"Critical Server Error: {e}")
-        httpd.server_close()
+        attributes.append(f'size="{os.path.getsize(path)}"')
+    except OSError:
+        pass
+    if info['duration']:
+        attributes.append(f'duration="{format_duration(info["duration"])}"')
+    if info['width'] and info['height']:
+        attributes.append(f'resolution="{info["width"]}x{info["height"]}"')
+    if info['bitrate']:
+        # res@bitrate is in bytes per second
+        attributes.append(f'bitrate="{info["bitrate"] // 8}"')
+    return " ".join(attributes)
 
-# --- Play ---
-play_xml = """<?xml version="1.0" encoding="utf-8"?>
-<s:Envelope s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/" xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
-  <s:Body>
-    <u:Play xmlns:u="urn:schemas-upnp-org:service:AVTransport:1">
-      <InstanceID>0</InstanceID>
-      <Speed>1</Speed>
-    </u:Play>
-  </s:Body>
-</s:Envelope>"""
-
-# --- Stop ---
-stop_xml = """<?xml version="1.0" encoding="utf-8"?>
-<s:Envelope s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/" xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">
-  <s:Body>
-    <u:Stop xmlns:u="urn:schemas-upnp-org:service:AVTransport:1">
-      <InstanceID>0</InstanceID>
-    </u:Stop>
-  </s:Body>
-</s:Envelope>"""
-
-# --- PositionInfo ---
-PositionInfo_xml = """<?xml version="1.0" encoding="UTF-8"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:GetPositionInfo xmlns:u="urn:schemas-upnp-org:service:AVTransport:1"><InstanceID>0</InstanceID></u:GetPositionInfo></s:Body></s:Envelope>"""
-
-# --- Pause ---
-pause_xml = """
-<?xml version="1.0"?>
-<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
-    s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
-    <s:Body>
-        <u:Pause xmlns:u="urn:schemas-upnp-org:service:AVTransport:1">
-            <InstanceID>0</InstanceID> 
-        </u:Pause>
-    </s:Body>
-</s:Envelope>"""
 
-# --- GetTransportInfo Loop ---
-def get_transport_info_loop():
-    proc_running = True
-    paused = False
-    ctrl_held = False
-    lock = threading.Lock()
-    stop_event = threading.Event()  # Add an event to signal the listener to stop
-    
-    def on_press(key):
-        nonlocal paused, proc_running, ctrl_held
-        
-        # Check if the stop event is set
-        if stop_event.is_set():
-            return False  # This will stop the listener
-        
-        # Check if Control key is pressed
-        if hasattr(keyboard, 'Key') and isinstance(key, keyboard.Key) and key in (keyboard.Key.ctrl_l, keyboard.Key.ctrl_r, keyboard.Key.ctrl):
-            ctrl_held = True
-            return
-        
-        # Handle Ctrl+key combinations when ctrl is held
-        if ctrl_held:
-            try:
-                if hasattr(key, 'char') and key.char:
-                    if key.char == 'p':
-                        with lock:
-                            paused = True
-                            pause_response = send_upnp_request("urn:schemas-upnp-org:service:AVTransport:1#Pause", pause_xml)
-                            if pause_response:
-                                print(f"pause_response: {pause_response}")
-                            print("Loop paused")
-                    elif key.char == 'r':
-                        with lock:
-                            paused = False
-                            Play_info_response = send_upnp_request("urn:schemas-upnp-org:service:AVTransport:1#Play", play_xml)
-                            if Play_info_response:
-                                print(f"Play_info_response: {Play_info_response}")
-                            print("Loop resumed")
-                    elif key.char == 'n':
-                        with lock:
-                            print("Ctrl+n pressed. Exiting loop and go to the next song.")
-                            proc_running = False
-            except (AttributeError, TypeError):
-                pass
+# --- Subtitles ---
+SUBTITLE_EXTENSIONS = ('.srt', '.vtt')
+# Embedded subtitle codecs that can be converted to SRT (bitmap subtitles cannot)
+TEXT_SUBTITLE_CODECS = ('subrip', 'webvtt', 'ass', 'ssa', 'mov_text')
+SUBTITLE_LANGUAGE = re.compile(r'[A-Za-z]{2,3}(-[A-Za-z]{2})?')
+VTT_TIMESTAMP = re.compile(r'(?:(\d+):)?(\d{2}):(\d{2})\.(\d{3})')
+# VTT markup other than <i>, <b> and <u>, which SRT renderers understand
+VTT_TAG = re.compile(r'<(?!/?[ibu]>)[^>]*>')
 
-    def on_release(key):
-        nonlocal ctrl_held
-        # Check if the stop event is set
-        if stop_event.is_set():
-            return False  # This will stop the listener
-            
-        if hasattr(keyboard, 'Key') and isinstance(key, keyboard.Key) and key in (keyboard.Key.ctrl_l, keyboard.Key.ctrl_r, keyboard.Key.ctrl):
-            ctrl_held = False
 
-    # Start keyboard listener in a separate thread
-    listener = keyboard.Listener(on_press=on_press, on_release=on_release)
-    listener.daemon = True
-    listener.start()
+def build_subtitle_index(directory):
+    """
+    Maps the name of each video (without extension) to the sidecar subtitles
+    next to it. "movie.srt" belongs to "movie.mkv"; "movie.en.srt" also does,
+    with language "en".
 
+    Returns:
+        A dict of video name to a list of (language or None, subtitle filename).
+    """
+    index = {}
     try:
-        while proc_running:
-            with lock:
-                if not proc_running:
-                    break
-                
-            if paused:
-                time.sleep(0.1)
-                continue
-                
-            get_transport_info_xml = """<?xml version="1.0"?>
-            <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
-              <s:Body>
-                <u:GetTransportInfo xmlns:u="urn:schemas-upnp-org:service:AVTransport:1">
-                  <InstanceID>0</InstanceID>
-                </u:GetTransportInfo>
-              </s:Body>
-            </s:Envelope>"""
-            
-            transport_info_response = send_upnp_request("urn:schemas-upnp-org:service:AVTransport:1#GetTransportInfo", get_transport_info_xml)
-            
-            if not transport_info_response:
-                print("GetTransportInfo request failed.")
-                break
+        filenames = os.listdir(directory)
+    except OSError as e:
+        print(f"Error listing subtitles in {directory}: {e}")
+        return index
+    for filename in filenames:
+        index_subtitle(index, filename)
+    return index
 
-            print("GetTransportInfo request sent and response received. Parsing...")
-            namespaces = {'s': 'http://schemas.xmlsoap.org/soap/envelope/', 'u': 'urn:schemas-upnp-org:service:AVTransport:1'}
-            root, error = parse_xml_response(transport_info_response, namespaces)
-            
-            if root is None:
-                print(f"Error parsing XML: {error}")
-                break
 
-            try:
-                transport_state = root.find('.//CurrentTransportState', namespaces=namespaces).text
-                print(f"Transport status: {transport_state}")
-                
-                if transport_state == "STOPPED":
-                    print("Player is STOPPED....")
-                    proc_running = False
-                    
-                transport_status = root.find('.//CurrentTransportStatus', namespaces=namespaces).text if root.find('.//CurrentTransportStatus', namespaces=namespaces) is not None else "N/A"
-                print(f"Specific state: {transport_status}")
-                
-            except AttributeError as e:
-                print(f"Error during XML element search: {e}")
-                print(transport_info_response)
-                break
+def index_subtitle(index, filename):
+    """Adds a sidecar subtitle file to a subtitle index, ignoring other files."""
+    stem, extension = os.path.splitext(filename)
+    if extension.lower() not in SUBTITLE_EXTENSIONS:
+        return
+    index.setdefault(stem, []).append((None, filename))
+    base, _, language = stem.rpartition('.')
+    if base and SUBTITLE_LANGUAGE.fullmatch(language):
+        index.setdefault(base, []).append((language.lower(), filename))
 
-            time.sleep(10)
-            
-    finally:
-        # Set the stop event to signal the listener to stop
-        stop_event.set()
-        
-        # Create a timeout for the join operation
-        join_timeout = 0.5  # 500ms should be enough for the listener to stop
-        join_start = time.time()
-        
-        while listener.is_alive() and (time.time() - join_start) < join_timeout:
-            time.sleep(0.1)  # Short sleep to prevent CPU spinning
-        
-        if listener.is_alive():
-            print("Warning: Keyboard listener thread didn't terminate cleanly")
+
+def subtitle_rank(subtitle):
+    """Sort key putting the languages of subtitle_languages first, in their order."""
+    language, filename = subtitle
+    if language in config.subtitle_languages:
+        return config.subtitle_languages.index(language), filename
+    return len(config.subtitle_languages), filename
 
 
+def read_subtitle_text(path):
+    """Reads a subtitle file, which are often not UTF-8."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    for encoding in ('utf-8-sig', 'cp1252'):
+        try:
+            return data.decode(encoding)
+        except UnicodeDecodeError:
+            pass
+    return data.decode('latin-1')
 
 
-def extract_number_from_filename(filename):
+def srt_timestamp(vtt_time):
+    """Converts a VTT timestamp ([hh:]mm:ss.ttt) to SRT (hh:mm:ss,ttt)."""
+    match = VTT_TIMESTAMP.fullmatch(vtt_time)
+    if not match:
+        raise ValueError(f"Invalid VTT timestamp {vtt_time!r}")
+    hours = int(match.group(1) or 0)
+    return f"{hours:02d}:{match.group(2)}:{match.group(3)},{match.group(4)}"
+
+
+def vtt_to_srt(text):
+    """Converts WebVTT to SRT, dropping the header, NOTE/STYLE/REGION blocks and cue settings."""
+    cues = []
+    for block in re.split(r'\n[ \t]*\n', text.replace('\r\n', '\n').replace('\r', '\n')):
+        lines = block.strip('\n').split('\n')
+        timing = next((i for i, line in enumerate(lines) if '-->' in line), None)
+        if timing is None:
+            continue
+        start, _, end = lines[timing].partition('-->')
+        end = end.split()[0] if end.split() else ''
+        cue_text = VTT_TAG.sub('', "\n".join(lines[timing + 1:]))
+        cues.append(f"{len(cues) + 1}\n{srt_timestamp(start.strip())} --> {srt_timestamp(end)}\n{cue_text}")
+    return "\n\n".join(cues) + "\n"
+
+
+def subtitle_cache_path(source_path, label):
+    """Returns the cache file for a subtitle, named after the source path, size and mtime."""
+    stat_result = os.stat(source_path)
+    key = f"{os.path.abspath(source_path)}|{stat_result.st_size}|{int(stat_result.st_mtime)}|{label}"
+    return os.path.join(config.subtitle_cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16] + ".srt")
+
+
+def write_cache_file(path, text):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_file = path + ".tmp"
+    with open(temp_file, "w", encoding='utf-8') as f:
+        f.write(text)
+    os.replace(temp_file, path)
+
+
+def convert_subtitle(path):
     """
-    Extracts the number from a filename, handling different variations.
+    Returns a UTF-8 SRT copy of a sidecar subtitle file. The conversion is done
+    once; later calls (and later runs) reuse the cached file.
     """
-    match = re.match(r"^(\d*)(\D*)", filename)  # Modified to handle numbers without leading zeros
-    if match:
-        number_str = match.group(1)
-        if number_str:
-            return int(number_str)  # Directly converts to integer
-        else:
-            return 0  # Handles the case of "file" without a number
-    else:
-        return None  # Handles invalid filenames
+    cached = subtitle_cache_path(path, 'sidecar')
+    if not os.path.exists(cached):
+        text = read_subtitle_text(path)
+        if path.lower().endswith('.vtt'):
+            text = vtt_to_srt(text)
+        write_cache_file(cached, text.replace('\r\n', '\n'))
+    return cached
 
 
-def filter_files_by_number(directory, threshold, order_files):
-    """Filters files in a directory based on a number in their name.
+# Embedded subtitle extractions, by cached SRT path: each is tried once per run
+subtitle_extractions = {}
+subtitle_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='subtitle')
 
-    Args:
-        directory: The path to the directory.
-        threshold: The minimum number that the file number must be.
-        order_files: A boolean value indicating whether to order the files.
+
+def extract_embedded_subtitle(path):
+    """
+    Extracts the first subtitle track of a video to a cached SRT file with
+    ffmpeg. Returns the cached path, or None if ffmpeg is not installed.
+    """
+    cached = subtitle_cache_path(path, 'embedded')
+    if os.path.exists(cached):
+        return cached
+    if shutil.which('ffmpeg') is None:
+        return None
+    os.makedirs(config.subtitle_cache_dir, exist_ok=True)
+    temp_file = cached + ".tmp"
+    subprocess.run(['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', path, '-map', '0:s:0', '-f', 'srt', temp_file],
+                   capture_output=True, timeout=120, check=True)
+    os.replace(temp_file, cached)
+    return cached
+
+
+def embedded_subtitle(path):
+    """
+    Returns the cached SRT of the subtitle track embedded in a video. When it
+    is not extracted yet, the extraction is started in the background and
+    None is returned: the video is advertised without it this time.
+    """
+    cached = subtitle_cache_path(path, 'embedded')
+    if os.path.exists(cached):
+        return cached
+    if cached not in subtitle_extractions:
+        def extract():
+            try:
+                extract_embedded_subtitle(path)
+            except (OSError, subprocess.SubprocessError) as e:
+                print(f"Error extracting subtitle from {path}: {e}")
+        print(f"Extracting the subtitle of {path} in the background.")
+        subtitle_extractions[cached] = subtitle_pool.submit(extract)
+    return None
+
+
+def prepare_subtitles(filename, video_info):
+    """
+    Returns the SRT files to advertise for a video, preferred language first.
+    Sidecar files win over the subtitle track embedded in the video, which
+    is only advertised once it has been extracted.
 
     Returns:
-        A list of filenames that meet the criteria.
+        A list of (language or None, path of the cached SRT file).
     """
+    subtitles = []
+    for language, subtitle_filename in sorted(subtitle_index.get(os.path.splitext(filename)[0], []), key=subtitle_rank):
+        try:
+            subtitles.append((language, convert_subtitle(os.path.join(config.directory_path, subtitle_filename))))
+        except (OSError, ValueError) as e:
+            print(f"Error converting subtitle {subtitle_filename}: {e}")
+    if not subtitles and video_info.get('subtitle_codec') in TEXT_SUBTITLE_CODECS:
+        try:
+            extracted = embedded_subtitle(os.path.join(config.directory_path, filename))
+        except OSError as e:
+            print(f"Error extracting subtitle from {filename}: {e}")
+            extracted = None
+        if extracted:
+            subtitles.append((None, extracted))
+    return subtitles
 
-    # Check that the directory exists
-    if not os.path.isdir(directory):
-        print(f"The directory {directory} does not exist.")
-        return []  # Return an empty list if the directory does not exist
 
-    # List to store the files that meet the criteria
-    filtered_files = []
+# --- HLS segments ---
+HLS_PLAYLIST_MIME = 'application/vnd.apple.mpegurl'
+HLS_SEGMENT_MIME = 'video/mp2t'
+# Codecs that can be copied into MPEG-TS segments without transcoding
+HLS_VIDEO_CODECS = ('h264', 'hevc', 'mpeg2video')
+HLS_AUDIO_CODECS = ('aac', 'ac3', 'eac3', 'mp3', None)
+HLS_MEMBER = re.compile(r'index\.m3u8|seg\d{5}\.ts')
+HLS_WAIT_TIMEOUT = 30
 
-    # Iterate through all the files in the directory
-    for filename in os.listdir(directory):
-        # Check if the file has extension .mp3 or .flac
-        if filename.endswith('.mkv') or filename.endswith('.webm')  or filename.endswith('.mp4'):
-            try:
-                # Extract the first three characters and convert them to a number
-                file_number = extract_number_from_filename(filename)
-                # Add the file to the list if the number is greater than the threshold
-                if file_number >= threshold:
-                    filtered_files.append((file_number, filename))
-            except ValueError:
-                # Ignore files that do not start with a valid number
-                print(f"Error file ignored: {filename}")
-                continue
 
-    # Sort or shuffle the files based on the order_files variable
-    if order_files:
-        sorted_files = sorted(filtered_files)
-    else:
-        random.shuffle(filtered_files)
-        sorted_files = filtered_files
+class HLSSession:
+    """
+    Segments one video into an HLS playlist and MPEG-TS segments with ffmpeg.
 
-    # Extract only the filenames from the list of tuples
-    sorted_files_names = [filename for _, filename in sorted_files]
+    ffmpeg copies the streams, so segmenting runs much faster than playback and
+    the renderer can start on the first segments while the rest are written.
+    The segments stay in the cache directory, so the file is only segmented once.
+    """
+
+    def __init__(self, source_path, directory):
+        self.source_path = source_path
+        self.directory = directory
+        self.playlist = os.path.join(directory, 'index.m3u8')
+        self.process = None
+        self.lock = threading.Lock()
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def read_playlist(self):
+        try:
+            with open(self.playlist, encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def complete(self):
+        playlist = self.read_playlist()
+        return playlist is not None and '#EXT-X-ENDLIST' in playlist
+
+    def start(self):
+        """Starts ffmpeg unless the segments are cached or already being written."""
+        with self.lock:
+            if self.running():
+                return
+            if self.complete():
+                # Mark as recently used for prune_hls_cache()
+                os.utime(self.directory)
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            prune_hls_cache()
+            print(f"Segmenting {self.source_path} into {self.directory}")
+            self.process = subprocess.Popen(
+                ['ffmpeg', '-nostdin', '-v', 'error', '-y', '-i', self.source_path,
+                 '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy',
+                 '-f', 'hls', '-hls_time', str(config.hls_segment_duration), '-hls_playlist_type', 'event',
+                 '-hls_flags', 'temp_file', '-hls_segment_filename', os.path.join(self.directory, 'seg%05d.ts'),
+                 self.playlist],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def member_entry(self, member, timeout=HLS_WAIT_TIMEOUT):
+        """
+        Returns a content table entry for the playlist or one of the segments,
+        waiting for ffmpeg to finish it if needed.
+
+        Returns:
+            The entry, or None if the name is invalid or the file never appears.
+        """
+        if not HLS_MEMBER.fullmatch(member):
+            return None
+        path = os.path.join(self.directory, member)
+        deadline = time.monotonic() + timeout
+        while True:
+            # A segment is complete once ffmpeg has listed it in the playlist
+            playlist = self.read_playlist()
+            if playlist is not None and (member == 'index.m3u8' or member in playlist):
+                break
+            if not self.running() or time.monotonic() >= deadline:
+                return None
+            time.sleep(0.2)
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            return None
+        return {
+            'path': path,
+            'size': stat_result.st_size,
+            'mime': HLS_PLAYLIST_MIME if member == 'index.m3u8' else HLS_SEGMENT_MIME,
+            'mtime': stat_result.st_mtime,
+        }
+
+
+# HLS sessions by source path
+hls_sessions = {}
+
+
+def prune_hls_cache():
+    """Removes the least recently used segment directories beyond hls_cache_limit megabytes."""
+    active = {session.directory for session in hls_sessions.values() if session.running()}
+    directories = []
+    total = 0
+    try:
+        names = os.listdir(config.hls_cache_dir)
+    except OSError:
+        return
+    for name in names:
+        directory = os.path.join(config.hls_cache_dir, name)
+        try:
+            size = sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+            directories.append((os.stat(directory).st_mtime, directory, size))
+        except OSError:
+            continue
+        total += size
+    for _, directory, size in sorted(directories):
+        if total <= config.hls_cache_limit * 1e6:
+            break
+        if directory in active:
+            continue
+        shutil.rmtree(directory, ignore_errors=True)
+        total -= size
+
+
+def use_hls(file_path, video_info):
+    """Returns True if a video should be sent as HLS segments rather than as one file."""
+    if config.hls_mode == 'off':
+        return False
+    if shutil.which('ffmpeg') is None:
+        print("HLS disabled: ffmpeg is not installed.")
+        return False
+    if video_info['video_codec'] not in HLS_VIDEO_CODECS or video_info['audio_codec'] not in HLS_AUDIO_CODECS:
+        print(f"HLS not used for {file_path}: codecs {video_info['video_codec']}/{video_info['audio_codec']} cannot be segmented without transcoding.")
+        return False
+    try:
+        return config.hls_mode == 'always' or os.path.getsize(file_path) >= config.hls_min_size * 1e6
+    except OSError:
+        return False
+
+
+def register_hls(file_path, caption_url=None):
+    """
+    Starts segmenting a video and registers it in the content table.
+
+    Returns:
+        The path of the playlist relative to the server root, or None if the
+        file cannot be read.
+    """
+    try:
+        stat_result = os.stat(file_path)
+    except OSError as e:
+        print(f"Error registering {file_path}: {e}")
+        return None
+    absolute_path = os.path.abspath(file_path)
+    digest = hashlib.sha1(absolute_path.encode('utf-8')).hexdigest()[:16]
+    # The cache directory changes with the file, so edited files are segmented again
+    cache_key = f"{absolute_path}|{stat_result.st_size}|{int(stat_result.st_mtime)}"
+    directory = os.path.join(config.hls_cache_dir, hashlib.sha1(cache_key.encode('utf-8')).hexdigest()[:16])
+
+    session = hls_sessions.get(absolute_path)
+    if session is None or session.directory != directory:
+        session = HLSSession(file_path, directory)
+        hls_sessions[absolute_path] = session
+    session.start()
+
+    content_id = digest + ".hls"
+    with content_table_lock:
+        content_table[content_id] = {
+            'path': file_path,
+            'size': stat_result.st_size,
+            'mime': HLS_PLAYLIST_MIME,
+            'mtime': stat_result.st_mtime,
+            'caption_url': caption_url,
+            'hls': session,
+        }
+        evict_content()
+    return content_id + "/index.m3u8"
 
-    return sorted_files_names  # Return the list of filenames
 
 def replace_special_characters(text):
   """
@@ -715,95 +4268,380 @@ def replace_special_characters(text):
   return text
 
 
-# Run the filter and get the list of files
-filtered_file_list = filter_files_by_number(directory_path, threshold, order_files)
+# --- Configuration reload ---
+# Options that change which files are queued, or in which order
+QUEUE_OPTIONS = {'threshold', 'order_files', 'directory_path', 'include_unnumbered', 'shuffle_mode', 'repeat_mode', 'playlist'}
+CONFIG_SETTLE_TIME = 0.5
+config_reload_requested = threading.Event()
+# Set when the queue has to be rebuilt, which the main loop does between two files
+queue_rebuild_requested = threading.Event()
+
+
+def reload_config():
+    """
+    Re-reads config.ini and applies the changed values without interrupting
+    the file being played. Options that are not reloadable keep their value.
+    """
+    current = config.values()
+    values = load_config(CONFIG_FILE, current)
+    changed = set()
+    for option in CONFIG_OPTIONS:
+        if values[option.variable] == current[option.variable]:
+            continue
+        if not option.reloadable:
+            print(f"{option.name} changed, restart to apply it.")
+            values[option.variable] = current[option.variable]
+            continue
+        changed.add(option.variable)
+    if not changed:
+        return
+    config.update(values)
+    print(f"Configuration reloaded: {', '.join(sorted(changed))}")
+    apply_config_changes(changed)
+
+
+def config_mtime():
+    try:
+        return os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def watch_config():
+    """Reloads the configuration on SIGHUP or when config.ini changes."""
+    last_mtime = config_mtime()
+    while True:
+        requested = config_reload_requested.wait(config.config_check_interval or None)
+        config_reload_requested.clear()
+        mtime = config_mtime()
+        if not requested and mtime != last_mtime:
+            # Wait until the editor has finished writing the file
+            time.sleep(CONFIG_SETTLE_TIME)
+            if config_mtime() != mtime:
+                continue
+        if requested or mtime != last_mtime:
+            last_mtime = mtime
+            try:
+                reload_config()
+            except Exception as e:
+                print(f"Error reloading configuration: {e}")
+
+
+def start_config_watcher():
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: config_reload_requested.set())
+    watcher = threading.Thread(target=watch_config)
+    watcher.daemon = True
+    watcher.start()
+
+
+def apply_config_changes(changed):
+    """Passes reloaded values on to the objects that were created from them."""
+    global_bucket.rate = config.max_rate
+    background_bucket.rate = config.background_rate
+    play_history.history_size = config.history_size
+    volume_controller.interval = config.volume_interval
+    if 'subtitles' in changed:
+        subtitle_index.clear()
+        if config.subtitles:
+            subtitle_index.update(build_subtitle_index(config.directory_path))
+    if config.video_probe != 'none' and video_metadata is None:
+        start_video_probes()
+    if changed & {'watch_folder', 'directory_path'}:
+        restart_folder_watcher()
+    if 'quirks_file' in changed:
+        apply_renderer_quirks(RENDERER_LOCATION)
+    if changed & QUEUE_OPTIONS:
+        queue_rebuild_requested.set()
+    library_changes.put(('config', None))
+
+
+def rebuild_queue():
+    """Lists the files again with the reloaded options. The current file keeps playing."""
+    if config.playlist:
+        play_queue.reconfigure([], config.order_files, config.shuffle_mode, config.repeat_mode)
+        start_playlist_loader(play_queue.current if config.order_files else None)
+    else:
+        files = filter_files_by_number(config.directory_path, config.threshold, config.order_files, config.include_unnumbered)
+        play_queue.reconfigure(files, config.order_files, config.shuffle_mode, config.repeat_mode)
+    prepared_tracks.clear()
+    if config.subtitles:
+        subtitle_index.clear()
+        subtitle_index.update(build_subtitle_index(config.directory_path))
+    if video_metadata:
+        start_video_probes()
+    print(f"Queue: {len(play_queue)} files, shuffle_mode: {config.shuffle_mode}, repeat_mode: {config.repeat_mode}")
+
+
+# Run the filter and get the list of files, a playlist is read in the background instead
+filtered_file_list = [] if config.playlist else filter_files_by_number(config.directory_path, config.threshold, config.order_files, config.include_unnumbered)
+play_history = PlayHistory(config.history_file, config.history_size)
+play_queue = PlayQueue(filtered_file_list, config.order_files, config.shuffle_mode, config.repeat_mode, play_history)
+print(f"Queue: {len(play_queue)} files, shuffle_mode: {config.shuffle_mode}, repeat_mode: {config.repeat_mode}")
+
+resume_file = None
+resume_time = None
+resume_state = load_resume_state()
+if resume_state and config.playlist and is_media_file(resume_state['filename']) \
+        and os.path.isfile(os.path.join(config.directory_path, resume_state['filename'])):
+    # The playlist is not read yet, the resumed file goes first
+    play_queue.enqueue(resume_state['filename'])
+if resume_state and play_queue.resume_from(resume_state['filename']):
+    resume_file = resume_state['filename']
+    resume_time = resume_state.get('rel_time')
+    print(f"Resuming {resume_file} at {resume_time}")
+
+subtitle_index = build_subtitle_index(config.directory_path) if config.subtitles else {}
+
+video_metadata = None
+
+def start_video_probes():
+    """Probes the queued files in the background, in playing order."""
+    global video_metadata
+    if video_metadata is None:
+        video_metadata = VideoMetadataCache(config.video_cache_file, config.video_probe_workers)
+    for queued_file in list(play_queue.queue):
+        video_metadata.submit(os.path.join(config.directory_path, queued_file))
+
+if config.video_probe != 'none':
+    start_video_probes()
+
+if config.playlist:
+    start_playlist_loader(resume_file if config.order_files else None)
+
+start_notifications()
+
+# --- Listen for renderers joining and leaving the network ---
+if config.ssdp_listen:
+    start_ssdp_listener()
 
 # --- run web server ---
-web_server_thread = threading.Thread(target=run_web_server, args=(SERVER_PORT,))
+web_server_thread = threading.Thread(target=run_web_server, args=(config.SERVER_PORT,))
 web_server_thread.daemon = True
 web_server_thread.start()
 time.sleep(1)
 
-CONTROL_URL=orchestrate_ssdp()
+RENDERER_LOCATION, CONTROL_URL = orchestrate_ssdp()
+if not CONTROL_URL:
+    print("No renderer selected.")
+    sys.exit(0)
+# Advertise the address the renderer reaches us on, not just the first one found
+ip_address = get_local_ip(urlparse(CONTROL_URL).hostname) or ip_address
+print(f"Serving on {ip_address}")
+
+renderer_health.watch(get_device_description(RENDERER_LOCATION).root_device['udn'], RENDERER_LOCATION)
+apply_renderer_quirks(RENDERER_LOCATION)
+
+volume_controller = VolumeController(config.volume_interval)
+volume_controller.start()
+start_config_watcher()
+restart_folder_watcher()
 # Play mp3 to upnp device
-FILE_PATH_ICON = "http://" + ip_address + ":" + str(SERVER_PORT) + "/icons8-python-100.png"
-for filename in filtered_file_list:
-    print(filename)
+ICON_ID = register_content("./icons8-python-100.png", "icons8-python-100.png") or "icons8-python-100.png"
+FILE_PATH_ICON = "http://" + url_host(ip_address) + ":" + str(config.SERVER_PORT) + "/" + ICON_ID
+
+def prepare_track(filename):
+    """
+    Registers a file in the content table and builds its SetAVTransportURI request.
+
+    Returns:
+        A dict with the title, artist, URI, MIME type of the URI and
+        SetAVTransportURI xml of the track, or None if the file cannot be
+        served. When the URI is an HLS playlist, 'fallback' holds the URI,
+        MIME type and xml of the whole file.
+    """
     # --- Remove &
-    filename_view=filename
+    filename_view=os.path.basename(filename)
     filename_view=replace_special_characters(filename_view)
     print(filename_view)   
-    if filename.endswith('.mp4'):
-        filetocopy = "file.mp4"
-    elif filename.endswith('.mkv'):
-        filetocopy = "file.mkv"
-    elif filename.endswith('.webm'):
-        filetocopy = "file.webm"
-    FILE_PATH = "http://" + ip_address + ":" + str(SERVER_PORT) + "/" + filetocopy   
+    file_path = os.path.join(config.directory_path, filename)
+    # Neither waits for ffprobe nor ffmpeg, a file seen for the first time is sent with what is known
+    video_info = video_metadata.get(file_path) if video_metadata and config.video_probe != 'none' else new_video_info(None)
+    mime = video_mime_type(file_path, video_info)
+    server_url = "http://" + url_host(ip_address) + ":" + str(config.SERVER_PORT) + "/"
+    caption_urls = []
+    for language, subtitle_path in prepare_subtitles(filename, video_info):
+        subtitle_id = register_content(subtitle_path, mime='text/srt')
+        if subtitle_id:
+            caption_urls.append(server_url + subtitle_id)
+    caption_url = caption_urls[0] if caption_urls else None
+    content_id = register_content(file_path, mime=mime, caption_url=caption_url)
+    if content_id is None:
+        return None
+    FILE_PATH = server_url + content_id
+    res_elements = [f'<res {video_res_attributes(file_path, video_info, mime)}>{escape(FILE_PATH)}</res>']
+    caption_elements = []
+    for url in caption_urls:
+        caption_elements.append(f'<res protocolInfo="http-get:*:text/srt:*">{escape(url)}</res>')
+        caption_elements.append(f'<sec:CaptionInfoEx sec:type="srt">{escape(url)}</sec:CaptionInfoEx>')
     artist ="Python Script"
     print(f"artist: {artist}")
     album ="Python Script"
     print(f"album: {album}")
 
+    track = {'title': filename_view, 'artist': artist, 'uri': FILE_PATH,
+             'metadata': video_didl(filename_view, artist, album, res_elements + caption_elements), 'mime': mime}
+    # With HLS, the playlist comes first and the whole file stays as a fallback
+    if use_hls(file_path, video_info):
+        playlist_id = register_hls(file_path, caption_url)
+        if playlist_id:
+            playlist_url = server_url + playlist_id
+            duration = f' duration="{format_duration(video_info["duration"])}"' if video_info['duration'] else ''
+            playlist_res = f'<res protocolInfo="http-get:*:{HLS_PLAYLIST_MIME}:*"{duration}>{escape(playlist_url)}</res>'
+            fallback = {key: track[key] for key in ('uri', 'metadata', 'mime')}
+            track.update(uri=playlist_url, mime=HLS_PLAYLIST_MIME, fallback=fallback,
+                         metadata=video_didl(filename_view, artist, album, [playlist_res] + res_elements + caption_elements))
+    return track
+
+
+def video_didl(title, artist, album, res_elements):
+    """Builds the DIDL-Lite metadata of a video for SetAVTransportURI."""
+    res_didl = "\n    ".join(res_elements)
+    return f"""<DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/"
+            xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/"
+            xmlns:dc="http://purl.org/dc/elements/1.1/"
+            xmlns:dlna="urn:schemas-dlna-org:metadata-1-0"
+            xmlns:sec="http://www.sec.co.kr/">
+  <item id="1000" parentID="0" restricted="0">
+    <dc:title>{escape(title)}</dc:title>
+    <dc:description/>
+    {res_didl}
+    <upnp:album>{escape(album)}</upnp:album>
+    <upnp:artist>{escape(artist)}</upnp:artist>
+    <upnp:albumArtURI>{escape(FILE_PATH_ICON)}</upnp:albumArtURI>
+    <upnp:class>object.item.videoItem</upnp:class>
+  </item>
+</DIDL-Lite>"""
+
+
+def playable_track(track):
+    """
+    Returns the track with the URI the renderer plays: its HLS playlist, or
+    the whole file when the renderer does not take playlists. Returns None
+    if the renderer plays neither.
+    """
+    if renderer_accepts(track['mime']):
+        return track
+    fallback = track.get('fallback')
+    if fallback and renderer_accepts(fallback['mime']):
+        print(f"The renderer does not play {track['mime']}, sending the whole file as {fallback['mime']}")
+        return dict(track, **fallback)
+    print(f"The renderer does not play {(fallback or track)['mime']}, skipping {track['title']}")
+    return None
+
+
+# Tracks prepared ahead of time by prepare_next_track(), by filename
+prepared_tracks = {}
+
+def prepare_next_track():
+    """
+    Prepares the next track in the queue while the current one is still playing.
+
+    Returns:
+        The URI of the next track if the renderer was asked to play it after
+        the current one with SetNextAVTransportURI, None otherwise.
+    """
+    next_filename = play_queue.peek()
+    if next_filename and next_filename not in prepared_tracks:
+        track = prepare_track(next_filename)
+        if track:
+            prepared_tracks[next_filename] = track
+    track = prepared_tracks.get(next_filename)
+    # With repeat_mode one the same URI would not tell the tracks apart
+    if not quirks['set_next'] or not track or next_filename == play_queue.current:
+        return None
+    track = playable_track(track)
+    if track is None:
+        return None
+    SetNextAVTransportURI_info_response = invoke("AVTransport", "SetNextAVTransportURI", NextURI=track['uri'], NextURIMetaData=track['metadata'])
+    if SetNextAVTransportURI_info_response is None:
+        return None
+    print(f"SetNextAVTransportURI: {track['uri']}")
+    return track['uri']
+
+
+skipped = False
+started_uri = None  # The renderer is already playing it, see prepare_next_track()
+replay_file = None
+replayed_file = None
+while True:
+    if queue_rebuild_requested.is_set():
+        queue_rebuild_requested.clear()
+        rebuild_queue()
+    apply_library_changes()
+    if replay_file:
+        # The renderer was lost during this file, play it again from where it was
+        filename, replay_file = replay_file, None
+    else:
+        filename = play_queue.next_track(skipped)
+    if filename is None:
+        if playlist_loading.is_set():
+            apply_library_change(library_changes.get())
+            continue
+        if not (folder_watcher and config.watch_append):
+            break
+        print("End of the queue, waiting for new files in the watched folder...")
+        apply_library_change(library_changes.get())
+        continue
+    print(filename)
+    track = prepared_tracks.pop(filename, None) or prepare_track(filename)
+    if track is None:
+        skipped = True
+        continue
+    track = playable_track(track)
+    if track is None:
+        skipped = True
+        continue
+
     # Notification
-    show_notification(filename_view, artist)
-    
+    show_notification(track['title'], track['artist'])
+    set_playing_content(track['uri'])
 
-    # --- SetAVTransportURI completo ---
-    set_uri_xml = f"""<?xml version="1.0" encoding="UTF-8"?>
-<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
-  <s:Body>
-    <u:SetAVTransportURI xmlns:u="urn:schemas-upnp-org:service:AVTransport:1">
-      <InstanceID>0</InstanceID>
-      <CurrentURI>{FILE_PATH}</CurrentURI>
-      <CurrentURIMetaData>
-        &lt;DIDL-Lite xmlns="urn:schemas-upnp-org:metadata-1-0/DIDL-Lite/"
-                    xmlns:upnp="urn:schemas-upnp-org:metadata-1-0/upnp/"
-                    xmlns:dc="http://purl.org/dc/elements/1.1/"
-                    xmlns:dlna="urn:schemas-dlna-org:metadata-1-0"&gt;
-          &lt;item id="1000" parentID="0" restricted="0"&gt;
-            &lt;dc:title&gt;{filename_view}&lt;/dc:title&gt;
-            &lt;dc:description/&gt;
-
-            &lt;res protocolInfo="http-get:*:video/mp4:DLNA.ORG_OP=01"&gt;{FILE_PATH}&lt;/res&gt;
-
-            &lt;upnp:album&gt;{album}&lt;/upnp:album&gt;
-            &lt;upnp:artist&gt;{artist}&lt;/upnp:artist&gt;
-            &lt;upnp:albumArtURI&gt;{FILE_PATH_ICON}&lt;/upnp:albumArtURI&gt;
-
-            &lt;upnp:class&gt;object.item.videoItem&lt;/upnp:class&gt;
-          &lt;/item&gt;
-        &lt;/DIDL-Lite&gt;
-      </CurrentURIMetaData>
-    </u:SetAVTransportURI>
-  </s:Body>
-</s:Envelope>"""
-
-    print(f"SetAVTransportURI:  {set_uri_xml}")
-    # Copia file
-    file_copy = "./" + filetocopy  # Replace with the desired path for the copy
-    copy_file(directory_path + "/" + filename, file_copy)
-    # --- Send SOAP requests upnp ---
-    Stop_info_response = send_upnp_request("urn:schemas-upnp-org:service:AVTransport:1#Stop", stop_xml)
-    if Stop_info_response:
-        print(f"Stop_info_response: {Stop_info_response}")
-    time.sleep(1)
-    SetAVTransportURI_info_response = send_upnp_request("urn:schemas-upnp-org:service:AVTransport:1#SetAVTransportURI", set_uri_xml)
-    if SetAVTransportURI_info_response:
-        print(f"SetAVTransportURI_info_response: {SetAVTransportURI_info_response}")
-    time.sleep(1)
-    Play_info_response = send_upnp_request("urn:schemas-upnp-org:service:AVTransport:1#Play", play_xml)
-    if Play_info_response:
-        print(f"Play_info_response: {Play_info_response}")
-    time.sleep(5)
-    GetPositionInfo_info_response = send_upnp_request("urn:schemas-upnp-org:service:AVTransport:1#GetPositionInfo", PositionInfo_xml)
-    if GetPositionInfo_info_response:
-        print(f"GetPositionInfo_info_response: {GetPositionInfo_info_response}")
-    time.sleep(1)
+    # Queued with SetNextAVTransportURI, the renderer is already playing it
+    if track['uri'] == started_uri:
+        print(f"Playing gapless: {track['uri']}")
+    else:
+        print(f"SetAVTransportURI:  {track['uri']} {track['metadata']}")
+        # --- Send SOAP requests upnp ---
+        if quirks['stop_before_load']:
+            Stop_info_response = invoke("AVTransport", "Stop")
+            if Stop_info_response is not None:
+                print(f"Stop_info_response: {Stop_info_response}")
+            time.sleep(quirks['wait_after_stop'])
+        SetAVTransportURI_info_response = invoke("AVTransport", "SetAVTransportURI", CurrentURI=track['uri'], CurrentURIMetaData=track['metadata'])
+        if SetAVTransportURI_info_response is not None:
+            print(f"SetAVTransportURI_info_response: {SetAVTransportURI_info_response}")
+        time.sleep(quirks['wait_after_load'])
+        Play_info_response = invoke("AVTransport", "Play", Speed="1")
+        if Play_info_response is not None:
+            print(f"Play_info_response: {Play_info_response}")
+        time.sleep(quirks['wait_after_play'])
+    resumed = False
+    if filename == resume_file and parse_time(resume_time) and quirks['seek_unit'] != 'none':
+        Seek_info_response = invoke("AVTransport", "Seek", Unit=quirks['seek_unit'], Target=format_time(parse_time(resume_time)))
+        if Seek_info_response is not None:
+            print(f"Seek_info_response: {Seek_info_response}")
+        resumed = True
+    resume_file = None
+    # A resumed file keeps its saved position until the next position update
+    save_resume_state(filename, resume_time if resumed else "0:00:00")
     # --- Start the GetTransportInfo loop ---
-    get_transport_info_loop()
+    if filename != replayed_file:
+        play_history.record(filename)
+    replayed_file = None
+    try:
+        skipped, started_uri = get_transport_info_loop(filename, prepare_next_track)
+    except RendererLost as e:
+        resume_file, resume_time = filename, format_time(e.position or 0)
+        save_resume_state(resume_file, resume_time)
+        wait_for_renderer()
+        replay_file = replayed_file = filename
+        started_uri = None
+        continue
     print("End loop GetTransportInfo")
 
+clear_resume_state()
+
 # --- Keep the main program running (now just for the web server) ---
 try:
     while True:
@@ -0,0 +1,291 @@
+import gzip
+import json
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+# Impersonates a renderer recorded by upnp_play.py / upnp_play_video.py with capture_file set:
+#
+#     python3 upnp_replay.py <capture file> [port] [latency_scale]
+#
+# The renderer is announced and answers M-SEARCHes like the recorded one, serves the recorded
+# description and SCPDs and answers every SOAP action with the recorded responses, in the
+# recorded order and after the recorded latency multiplied by latency_scale (0 = at once).
+
+SSDP_MULTICAST_V4 = '239.255.255.250'
+SSDP_PORT = 1900
+SSDP_BUFFER_SIZE = 65507
+DEFAULT_PORT = 49152
+
+
+def load_capture(path):
+    """
+    Reads the records of a capture file.
+
+    A compressed capture cut short (upnp_play was killed) is read up to
+    where it ends, and lines that are not JSON are skipped.
+    """
+    records = []
+    opener = gzip.open if path.endswith('.gz') else open
+    try:
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    print(f"Skipping invalid line in {path}: {line[:80]!r}")
+    except EOFError:
+        print(f"{path} ends early, replaying the {len(records)} records read.")
+    return records
+
+
+def url_origin(url):
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+def url_path(url):
+    parsed = urlparse(url)
+    return parsed.path + ('?' + parsed.query if parsed.query else '')
+
+
+def parse_ssdp_headers(data):
+    """Returns the start line and the headers (upper case names) of an SSDP datagram."""
+    lines = data.splitlines()
+    headers = {}
+    for line in lines[1:]:
+        if not line.strip():
+            break
+        name, sep, value = line.partition(':')
+        if sep and name.strip().upper() not in headers:
+            headers[name.strip().upper()] = value.strip()
+    return (lines[0].strip() if lines else ''), headers
+
+
+def local_address_towards(host):
+    """Returns the local IP address used to reach host."""
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect((host, SSDP_PORT))
+            return sock.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+
+
+class ReplayRenderer:
+    """
+    The recorded traffic of one renderer, indexed for replay.
+
+    The renderer is the origin (scheme://host:port) most SOAP actions were
+    sent to. Its URLs in the recorded bodies, headers and datagrams are
+    rewritten to the address of the replay server when they are sent.
+    """
+
+    def __init__(self, records):
+        http_records = [record for record in records if record.get('kind') == 'http']
+        origins = Counter(url_origin(record['url']) for record in http_records if record.get('method') == 'POST')
+        if not origins:
+            origins = Counter(url_origin(record['url']) for record in http_records)
+        if not origins:
+            raise ValueError("no request to a renderer in the capture")
+        self.origin = origins.most_common(1)[0][0]
+
+        self.documents = {}  # path -> recorded GET, the first complete answer wins
+        self.actions = {}    # (path, SOAPAction) -> recorded POSTs, in order
+        self.cursors = {}    # (path, SOAPAction) -> index of the next answer
+        self.lock = threading.Lock()
+        for record in http_records:
+            if url_origin(record['url']) != self.origin:
+                continue
+            path = url_path(record['url'])
+            if record['method'] == 'GET':
+                if path not in self.documents or (record.get('status') == 200 and self.documents[path].get('status') != 200):
+                    self.documents[path] = record
+            elif record['method'] == 'POST':
+                action = (record.get('headers') or {}).get('SOAPAction', '').strip('"')
+                self.actions.setdefault((path, action), []).append(record)
+
+        # SSDP: the M-SEARCH answers, delayed as they were after the M-SEARCH, and the NOTIFYs
+        self.search_responses = []  # (delay, data)
+        self.notifies = []
+        search_time = None
+        for record in records:
+            if record.get('kind') == 'search':
+                search_time = record['t']
+            elif record.get('kind') == 'ssdp':
+                start_line, headers = parse_ssdp_headers(record['data'])
+                if url_origin(headers.get('LOCATION', '')) != self.origin:
+                    continue
+                if start_line.upper().startswith('HTTP/'):
+                    delay = record['t'] - search_time if search_time is not None else 0
+                    if record['data'] not in (data for _, data in self.search_responses):
+                        self.search_responses.append((max(0.0, delay), record['data']))
+                elif start_line.upper().startswith('NOTIFY') and headers.get('NTS') == 'ssdp:alive':
+                    if record['data'] not in self.notifies:
+                        self.notifies.append(record['data'])
+
+    def next_answer(self, path, action):
+        """Returns the recorded answer to the next call of action, the last one again once they run out."""
+        key = (path, action)
+        with self.lock:
+            answers = self.actions.get(key)
+            if not answers:
+                return None
+            index = self.cursors.get(key, 0)
+            self.cursors[key] = index + 1
+            return answers[min(index, len(answers) - 1)]
+
+    def rewrite(self, text, origin):
+        return text.replace(self.origin, origin) if text else text
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def replay_origin(self):
+        return f"http://{self.headers.get('Host') or self.server.server_address[0]}"
+
+    def replay(self, record):
+        """Sends a recorded response after its latency, or drops the connection if the request had failed."""
+        time.sleep(record.get('latency', 0) * self.server.latency_scale)
+        if 'status' not in record:
+            print(f"{self.command} {self.path}: recorded error {record.get('error')}")
+            self.close_connection = True
+            return
+        origin = self.replay_origin()
+        body = self.server.renderer.rewrite(record.get('response', ''), origin).encode('utf-8')
+        self.send_response(record['status'])
+        for name, value in (record.get('response_headers') or {}).items():
+            if name.lower() != 'content-length':
+                self.send_header(name, self.server.renderer.rewrite(value, origin))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_empty(self, status, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        record = self.server.renderer.documents.get(self.path)
+        if record is None:
+            self.send_empty(404)
+            return
+        etag = next((value for name, value in (record.get('response_headers') or {}).items() if name.lower() == 'etag'), None)
+        if etag and self.headers.get('If-None-Match') == etag:
+            time.sleep(record.get('latency', 0) * self.server.latency_scale)
+            self.send_empty(304, [('ETag', etag)])
+            return
+        self.replay(record)
+
+    do_HEAD = do_GET
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        action = self.headers.get('SOAPAction', '').strip('"')
+        record = self.server.renderer.next_answer(self.path, action)
+        if record is None:
+            print(f"No recorded answer to {action} on {self.path}")
+            self.send_empty(500)
+            return
+        print(f"{action.rpartition('#')[2]}: {record.get('status', record.get('error'))}")
+        self.replay(record)
+
+    def do_SUBSCRIBE(self):
+        # Events were not recorded: subscriptions are accepted and nothing is sent
+        sid = self.headers.get('SID') or f"uuid:{uuid.uuid4()}"
+        self.send_empty(200, [('SID', sid), ('TIMEOUT', self.headers.get('TIMEOUT') or 'Second-1800')])
+
+    def do_UNSUBSCRIBE(self):
+        self.send_empty(200)
+
+
+def ssdp_replay_data(renderer, data, port, host):
+    return renderer.rewrite(data, f"http://{host}:{port}")
+
+
+def answer_search(sock, renderer, port, data, addr, latency_scale):
+    """Answers an M-SEARCH for the recorded renderer with its recorded responses and delays."""
+    start_line, headers = parse_ssdp_headers(data)
+    if not start_line.upper().startswith('M-SEARCH'):
+        return
+    target = headers.get('ST', '')
+    host = local_address_towards(addr[0])
+    for delay, response in renderer.search_responses:
+        _, response_headers = parse_ssdp_headers(response)
+        if target not in ('ssdp:all', response_headers.get('ST')):
+            continue
+        timer = threading.Timer(delay * latency_scale, sock.sendto,
+                                args=(ssdp_replay_data(renderer, response, port, host).encode('utf-8'), addr))
+        timer.daemon = True
+        timer.start()
+
+
+def run_ssdp(renderer, port, latency_scale):
+    """Sends the recorded ssdp:alive NOTIFYs, then answers M-SEARCHes forever."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', SSDP_PORT))
+    mreq = socket.inet_aton(SSDP_MULTICAST_V4) + struct.pack('=I', socket.INADDR_ANY)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+    host = local_address_towards(SSDP_MULTICAST_V4)
+    for notify in renderer.notifies:
+        sock.sendto(ssdp_replay_data(renderer, notify, port, host).encode('utf-8'), (SSDP_MULTICAST_V4, SSDP_PORT))
+    while True:
+        try:
+            data, addr = sock.recvfrom(SSDP_BUFFER_SIZE)
+            answer_search(sock, renderer, port, data.decode('utf-8', errors='replace'), addr, latency_scale)
+        except OSError as e:
+            print(f"Error in SSDP: {e}")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python3 upnp_replay.py <capture file> [port] [latency_scale]")
+        sys.exit(1)
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PORT
+    latency_scale = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+
+    try:
+        renderer = ReplayRenderer(load_capture(sys.argv[1]))
+    except (OSError, ValueError) as e:
+        print(f"Error reading capture {sys.argv[1]}: {e}")
+        sys.exit(1)
+    print(f"Replaying {renderer.origin}: {len(renderer.documents)} documents, "
+          f"{sum(len(answers) for answers in renderer.actions.values())} SOAP answers, "
+          f"{len(renderer.search_responses)} M-SEARCH answers")
+
+    server = ThreadingHTTPServer(('', port), ReplayHandler)
+    server.daemon_threads = True
+    server.renderer = renderer
+    server.latency_scale = latency_scale
+
+    ssdp_thread = threading.Thread(target=run_ssdp, args=(renderer, port, latency_scale))
+    ssdp_thread.daemon = True
+    ssdp_thread.start()
+    print(f"Listening on port {port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()